@@ -0,0 +1,333 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import shlex
+import statistics
+import time
+from datetime import datetime
+
+import asyncpg
+
+from pg_rebuild_table.main import Command, __version__
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)s: %(message)s",
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO
+)
+
+TABLES = {
+    'narrow': {
+        'create': '''
+            create table bench_narrow(
+              id bigint primary key,
+              value integer not null,
+              created_at timestamp not null default now())''',
+        'fill': '''
+            insert into bench_narrow(id, value)
+              select i, (random() * 1000000)::integer
+                from generate_series(1, $1) i''',
+        'keys': 1,
+        'insert': 'insert into bench_narrow(id, value) values ($1, 1) on conflict do nothing',
+        'update': 'update bench_narrow set value = value + 1 where id = $1',
+        'delete': 'delete from bench_narrow where id = $1',
+    },
+    'wide': {
+        'create': '''
+            create table bench_wide(
+              id bigint primary key,
+              flag boolean,
+              small_value smallint,
+              value integer,
+              big_value bigint,
+              amount numeric(12, 2),
+              ratio double precision,
+              code char(3),
+              name text,
+              description varchar(200),
+              created_at timestamp,
+              updated_at timestamptz,
+              day date,
+              tags text[],
+              attrs jsonb,
+              uid uuid)''',
+        'fill': '''
+            insert into bench_wide
+              select i,
+                     i % 2 = 0,
+                     (i % 100)::smallint,
+                     i % 100000,
+                     i * 31,
+                     (random() * 10000)::numeric(12, 2),
+                     random(),
+                     'abc',
+                     md5(i::text),
+                     repeat(md5(i::text), 3),
+                     now(),
+                     now(),
+                     current_date,
+                     array['a', 'b', md5(i::text)],
+                     jsonb_build_object('i', i, 'r', random()),
+                     md5(i::text)::uuid
+                from generate_series(1, $1) i''',
+        'keys': 1,
+        'insert': 'insert into bench_wide(id, value, name) values ($1, 1, \'new\') on conflict do nothing',
+        'update': 'update bench_wide set value = value + 1, updated_at = now() where id = $1',
+        'delete': 'delete from bench_wide where id = $1',
+    },
+    'composite': {
+        'create': '''
+            create table bench_composite(
+              group_id integer,
+              item_id bigint,
+              value integer,
+              payload text,
+              primary key (group_id, item_id))''',
+        'fill': '''
+            insert into bench_composite
+              select i % 1000, i, (random() * 1000)::integer, md5(i::text)
+                from generate_series(1, $1) i''',
+        'keys': 2,
+        'insert': 'insert into bench_composite(group_id, item_id, value) values ($1, $2, 1) on conflict do nothing',
+        'update': 'update bench_composite set value = value + 1 where group_id = $1 and item_id = $2',
+        'delete': 'delete from bench_composite where group_id = $1 and item_id = $2',
+    },
+    'toast': {
+        'create': '''
+            create table bench_toast(
+              id bigint primary key,
+              value integer,
+              document text)''',
+        'fill': '''
+            insert into bench_toast
+              select i, i % 1000, d.document
+                from generate_series(1, $1) i
+               cross join lateral (select string_agg(md5(random()::text || i::text), '') as document
+                                     from generate_series(1, 100)) d''',
+        'keys': 1,
+        'insert': 'insert into bench_toast(id, value, document) values ($1, 1, repeat(md5(random()::text), 100)) on conflict do nothing',
+        'update': 'update bench_toast set value = value + 1 where id = $1',
+        'delete': 'delete from bench_toast where id = $1',
+    },
+}
+
+
+class WriteLoad:
+    logger = logging.getLogger('WriteLoad')
+
+    def __init__(self, pool, table, rows, clients):
+        self.pool = pool
+        self.table = table
+        self.rows = rows
+        self.clients = clients
+        self.latencies = []
+        self.running = False
+        self.tasks = []
+
+    def _get_key(self, key):
+        if self.table['keys'] == 2:
+            return key % 1000, key
+        return key,
+
+    async def _client(self):
+        async with self.pool.acquire() as conn:
+            while self.running:
+                operation = random.choices(('update', 'insert', 'delete'), weights=(70, 20, 10))[0]
+                if operation == 'insert':
+                    key = random.randint(self.rows + 1, self.rows * 2)
+                else:
+                    key = random.randint(1, self.rows)
+                start_time = time.monotonic()
+                try:
+                    await conn.execute(self.table[operation], *self._get_key(key))
+                except asyncpg.exceptions.PostgresError as e:
+                    self.logger.debug(f'{operation}: {e}')
+                    continue
+                self.latencies.append(time.monotonic() - start_time)
+
+    def start(self):
+        self.running = True
+        self.latencies = []
+        self.tasks = [asyncio.ensure_future(self._client()) for _ in range(self.clients)]
+
+    async def stop(self):
+        self.running = False
+        await asyncio.gather(*self.tasks)
+        return self.get_summary()
+
+    def get_summary(self):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return {
+            'transactions': len(latencies),
+            'avg_ms': statistics.mean(latencies) * 1000,
+            'p50_ms': latencies[int(len(latencies) * 0.50)] * 1000,
+            'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        }
+
+
+class Benchmark:
+    logger = logging.getLogger('Benchmark')
+
+    def __init__(self, args):
+        self.args = args
+        self.dbname = f'pg_rebuild_table_bench_{int(time.time())}'
+
+    def _connect_params(self, dbname):
+        return dict(
+            host=self.args.host,
+            port=self.args.port,
+            user=self.args.username,
+            password=self.args.password,
+            database=dbname,
+        )
+
+    def _command_args(self, table_name):
+        args = ['-T', table_name, '-d', self.dbname, '-ll', self.args.logging_level]
+        for option, value in (('-h', self.args.host), ('-p', self.args.port),
+                              ('-U', self.args.username), ('-W', self.args.password)):
+            if value:
+                args.extend([option, str(value)])
+        if self.args.chunk_limit:
+            args.extend(['--chunk_limit', str(self.args.chunk_limit)])
+        return args + self.args.rebuild_args
+
+    async def _prepare_table(self, conn, name, table):
+        self.logger.info(f'prepare table bench_{name}, rows: {self.args.rows}')
+        await conn.execute(table['create'])
+        await conn.execute(table['fill'], self.args.rows)
+        if self.args.bloat:
+            await conn.execute(
+                f'update bench_{name} set value = value where random() < $1',
+                self.args.bloat
+            )
+        await conn.execute(f'vacuum analyze bench_{name}')
+
+    async def _run_table(self, conn, pool, name, table):
+        await self._prepare_table(conn, name, table)
+        size_before = await conn.fetchval(f'select pg_total_relation_size(\'bench_{name}\')')
+
+        load = WriteLoad(pool, table, self.args.rows, self.args.clients)
+        load.start()
+        await asyncio.sleep(self.args.baseline_seconds)
+        baseline = await load.stop()
+
+        command = Command(self._command_args(f'bench_{name}'))
+        load.start()
+        rebuild_start_time = time.monotonic()
+        try:
+            for component in command.components:
+                await component.start()
+        finally:
+            rebuild_duration = time.monotonic() - rebuild_start_time
+            rebuild = await load.stop()
+            await command.stop()
+
+        size_after = await conn.fetchval(f'select pg_total_relation_size(\'bench_{name}\')')
+        stats = command.pg_rebuild_table.stats
+        copy_step = stats.steps.get('copy data')
+        copy_duration = copy_step.duration if copy_step else None
+        result = {
+            'table': name,
+            'rows': self.args.rows,
+            'duration': rebuild_duration,
+            'copy_rows': stats.copy_rows,
+            'copy_rows_per_sec': stats.copy_rows / copy_duration if copy_duration else None,
+            'delta_rows': stats.delta_rows,
+            'delta_drain_rows_per_sec': stats.delta_rows / stats.delta_duration if stats.delta_duration else None,
+            'lock_attempts': stats.lock_attempts,
+            'lock_hold_ms': stats.lock_time * 1000,
+            'size_before': size_before,
+            'size_after': size_after,
+            'size_reclaimed': size_before - size_after,
+            'latency_baseline': baseline,
+            'latency_rebuild': rebuild,
+            'trigger_overhead_pct': (
+                (rebuild['avg_ms'] / baseline['avg_ms'] - 1) * 100
+                if baseline and rebuild else None
+            ),
+            'steps': {k: dict(v) for k, v in stats.steps.items()},
+        }
+        self.logger.info(f'table bench_{name}: {json.dumps(result, default=str)}')
+        return result
+
+    async def run(self):
+        conn = await asyncpg.connect(**self._connect_params('postgres'))
+        await conn.execute(f'create database "{self.dbname}"')
+        await conn.close()
+        self.logger.info(f'database "{self.dbname}" created')
+        try:
+            conn = await asyncpg.connect(**self._connect_params(self.dbname))
+            pool = await asyncpg.create_pool(
+                min_size=self.args.clients,
+                max_size=self.args.clients,
+                **self._connect_params(self.dbname)
+            )
+            try:
+                results = {
+                    'version': __version__,
+                    'server_version': await conn.fetchval('select version()'),
+                    'time': datetime.now().isoformat(),
+                    'params': {k: v for k, v in vars(self.args).items() if k != 'password'},
+                    'results': [
+                        await self._run_table(conn, pool, name, TABLES[name])
+                        for name in self.args.tables
+                    ],
+                }
+            finally:
+                await pool.close()
+                await conn.close()
+        finally:
+            if not self.args.keep_database:
+                conn = await asyncpg.connect(**self._connect_params('postgres'))
+                await conn.execute(f'drop database if exists "{self.dbname}"')
+                await conn.close()
+                self.logger.info(f'database "{self.dbname}" dropped')
+
+        with open(self.args.output, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+        self.logger.info(f'results written to {self.args.output}')
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Benchmark of pg_rebuild_table on a throwaway database',
+        conflict_handler='resolve'
+    )
+    arg_parser.add_argument('-h', '--host', type=str, help='host for connect db.')
+    arg_parser.add_argument('-p', '--port', type=str, help='port for connect db.')
+    arg_parser.add_argument('-U', '--username', type=str, help='user for connect db.')
+    arg_parser.add_argument('-W', '--password', type=str, help='password for connect db.')
+    arg_parser.add_argument(
+        '--tables',
+        type=lambda s: [str(item) for item in s.split(',')],
+        default=list(TABLES),
+        help=f'Synthetic tables to rebuild (default={",".join(TABLES)}).'
+    )
+    arg_parser.add_argument('--rows', type=int, default=100000, help='Rows in each table (default=%(default)s).')
+    arg_parser.add_argument('--bloat', type=float, default=0.3, help='Fraction of rows updated before the rebuild (default=%(default)s).')
+    arg_parser.add_argument('--clients', type=int, default=4, help='Number of concurrent writers (default=%(default)s).')
+    arg_parser.add_argument('--baseline_seconds', type=int, default=10, help='Duration of the write load before the rebuild (default=%(default)s).')
+    arg_parser.add_argument('-cl', '--chunk_limit', type=int, help='chunk_limit passed to pg_rebuild_table.')
+    arg_parser.add_argument(
+        '--rebuild_args',
+        type=str,
+        default='',
+        help='Additional pg_rebuild_table arguments (example: "--reorder_columns").'
+    )
+    arg_parser.add_argument('--keep_database', action='store_true', help='Do not drop the benchmark database.')
+    arg_parser.add_argument('-o', '--output', default='bench_output.json', help='Output file (default=%(default)s).')
+    arg_parser.add_argument('-ll', '--logging_level', default='INFO', help='Logging level (default=%(default)s).')
+    args = arg_parser.parse_args()
+    args.rebuild_args = shlex.split(args.rebuild_args)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(Benchmark(args).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 
@@ -6,9 +7,18 @@ import asyncpg
 
 class Database:
     conn: asyncpg.Connection = None
+    pools: dict = None
     logger = logging.getLogger('Database')
+    close_timeout = 10
+    roles = {
+        # role: (max connections, server settings)
+        'ddl': (1, {}),
+        'copy': (None, {}),
+        'delta': (1, {}),
+        'monitor': (1, {'lock_timeout': '100ms', 'statement_timeout': '60s'}),
+    }
 
-    def __init__(self, host, port, username, password, dbname, lock_timeout, statement_timeout, work_mem, logging_level):
+    def __init__(self, host, port, username, password, dbname, lock_timeout, statement_timeout, work_mem, jobs, logging_level):
         if logging_level.upper() == 'DEBUG':
             self.logger.setLevel(logging.DEBUG)
         self.host = host
@@ -16,6 +26,7 @@ class Database:
         self.username = username
         self.password = password
         self.dbname = dbname
+        self.jobs = jobs
         self.server_settings = {
             'application_name': 'pg_rebuild_table',
             'search_path': 'public',
@@ -24,24 +35,49 @@ class Database:
             'work_mem': work_mem,
         }
 
-    async def start(self):
-        self.conn = await asyncpg.connect(
-            host=self.host,
-            port=self.port,
-            user=self.username,
-            password=self.password,
-            database=self.dbname,
-            server_settings=self.server_settings
-        )
-        await self.conn.set_type_codec(
+    @staticmethod
+    async def _init_connection(conn):
+        await conn.set_type_codec(
             'json',
             encoder=lambda x: json.dumps(x, default=str),
             decoder=json.loads,
             schema='pg_catalog'
         )
+
+    async def start(self):
+        self.pools = {}
+        for role, (max_size, server_settings) in self.roles.items():
+            self.pools[role] = await asyncpg.create_pool(
+                host=self.host,
+                port=self.port,
+                user=self.username,
+                password=self.password,
+                database=self.dbname,
+                min_size=0,
+                max_size=max_size or self.jobs,
+                server_settings={
+                    **self.server_settings,
+                    'application_name': f'{self.server_settings["application_name"]}:{role}',
+                    **server_settings,
+                },
+                init=self._init_connection
+            )
+        self.conn = await self.pools['ddl'].acquire()
         self.logger.info(f'Database "{self.dbname}" connection open')
 
+    def session(self, role):
+        return self.pools[role].acquire()
+
     async def stop(self):
-        if not self.conn.is_closed():
-            await self.conn.close()
-            self.logger.info(f'Database "{self.dbname}" connection closed')
+        if self.conn is not None:
+            await self.pools['ddl'].release(self.conn)
+            self.conn = None
+        for role, pool in (self.pools or {}).items():
+            try:
+                await asyncio.wait_for(pool.close(), self.close_timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning(f'Database "{self.dbname}" pool "{role}" terminated')
+                pool.terminate()
+            self.logger.debug(f'Database "{self.dbname}" pool "{role}" closed')
+        self.pools = None
+        self.logger.info(f'Database "{self.dbname}" connection closed')
@@ -0,0 +1,46 @@
+from collections import deque
+
+
+class DeltaConvergence:
+    def __init__(self, window=5):
+        # samples: (time, inflow rows total, applied rows, apply duration)
+        self.samples = deque(maxlen=window)
+
+    def add(self, timestamp, inflow_total, rows, duration):
+        self.samples.append((timestamp, inflow_total, rows, duration))
+
+    @property
+    def inflow_rate(self):
+        if len(self.samples) < 2:
+            return None
+        (first_time, first_inflow, *_), (last_time, last_inflow, *_) = self.samples[0], self.samples[-1]
+        if last_time <= first_time:
+            return None
+        return (last_inflow - first_inflow) / (last_time - first_time)
+
+    @property
+    def drain_rate(self):
+        rows = sum(s[2] for s in self.samples)
+        duration = sum(s[3] for s in self.samples)
+        if not rows or not duration:
+            return None
+        return rows / duration
+
+    def is_converging(self):
+        inflow_rate, drain_rate = self.inflow_rate, self.drain_rate
+        if inflow_rate is None or drain_rate is None or len(self.samples) < self.samples.maxlen:
+            return True
+        return inflow_rate < drain_rate
+
+    def predict_lock_ms(self):
+        # rows arrived during the last pass are applied before the lock,
+        # rows arrived during that apply are applied under the lock
+        if not self.samples:
+            return None
+        inflow_rate, drain_rate = self.inflow_rate, self.drain_rate
+        if inflow_rate is None:
+            return None
+        if drain_rate is None:
+            return 0.0 if inflow_rate == 0 else None
+        pre_lock_duration = inflow_rate * self.samples[-1][3] / drain_rate
+        return inflow_rate * pre_lock_duration / drain_rate * 1000
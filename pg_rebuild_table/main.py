@@ -1,8 +1,13 @@
 import argparse
 import asyncio
+import contextlib
+import gzip
 import logging
 import re
 import json
+import math
+import time
+from datetime import timedelta
 from pathlib import Path
 
 import asyncpg
@@ -10,6 +15,8 @@ from munch import Munch
 
 from pg_rebuild_table.acl import acl_to_grants
 from pg_rebuild_table.connection import Database
+from pg_rebuild_table.convergence import DeltaConvergence
+from pg_rebuild_table.profiles import get_phase_settings
 
 __version__ = '0.1.5'
 
@@ -23,9 +30,23 @@ logging.basicConfig(
 
 class PgRebuildTable:
     TABLE_INFO_QUERY = open(Path(__file__).parent / 'sql' / 'table_info_query.sql').read()
+    INDEX_INFO_QUERY = open(Path(__file__).parent / 'sql' / 'index_info_query.sql').read()
     logger = logging.getLogger('PgRebuildTable')
     service_schema = 'rebuild_table'
     min_delta_rows = 10000
+    delta_apply_batch_rows = 100000
+    step_size_source = {
+        'copy data': 'table_size',
+        'set logged': 'table_size',
+        'create pk index': 'indexes_size',
+        'create indexes': 'indexes_size',
+        'vacuum analyze': 'table_size',
+        'analyze': 'table_size',
+        'verify': 'table_size',
+    }
+    step_history_limit = 10
+    copy_range_blocks = 16384
+    delta_apply_interval = 1
 
     def __init__(
         self,
@@ -37,10 +58,28 @@ class PgRebuildTable:
         clean,
         only_switch,
         only_validate_constraints,
+        only_indexes,
+        index_bloat_threshold,
+        only_verify,
         chunk_limit,
+        copy_strategy,
         reorder_columns,
         set_column_order,
         set_data_type,
+        add_columns,
+        drop_columns,
+        archive,
+        archive_file,
+        low_wal,
+        plan,
+        space_limit,
+        phase_settings,
+        background_delta,
+        switch_target_ms,
+        prewarm,
+        prewarm_budget,
+        verify,
+        options,
         logging_level,
     ):
         if logging_level.upper() == 'DEBUG':
@@ -52,6 +91,11 @@ class PgRebuildTable:
             self.only_steps.append('switch')
         if only_validate_constraints:
             self.only_steps.append('validate_constraints')
+        if only_indexes:
+            self.only_steps.append('indexes')
+        self.index_bloat_threshold = index_bloat_threshold
+        if only_verify:
+            self.only_steps.append('verify')
         if table_full_name:
             table_full_name = table_full_name.split('.')
             if len(table_full_name) > 1:
@@ -64,9 +108,42 @@ class PgRebuildTable:
         self.make_backup = make_backup
         self.make_vacuum_analyze = make_vacuum_analyze
         self.chunk_limit = chunk_limit
+        self.copy_strategy = copy_strategy
         self.reorder_columns = reorder_columns
         self.set_column_order = set_column_order
         self.set_data_type = set_data_type
+        self.add_columns = add_columns
+        self.drop_columns = drop_columns
+        self.archive = archive or bool(archive_file)
+        self.archive_file = archive_file
+        self.low_wal = low_wal
+        self.plan = plan
+        self.space_limit = space_limit
+        self.phase_settings = phase_settings
+        self.logged_phases = set()
+        self.background_delta = background_delta
+        self.delta_applier = None
+        self.delta_applier_stop = None
+        self.switch_target_ms = switch_target_ms
+        self.prewarm = prewarm
+        self.prewarm_budget = prewarm_budget
+        self.verify = verify
+        self.options = options
+        self.run_id = None
+        self.run_done = False
+        self.stats = Munch(
+            steps={},
+            copy_rows=0,
+            archive_rows=0,
+            delta_rows=0,
+            delta_duration=0,
+            lock_attempts=0,
+            lock_time=0,
+            verify_ranges=0,
+            verify_mismatches=0,
+            verify_missing_ranges=0,
+            verify_missing_rows=0,
+        )
 
     async def _get_table(self):
         self.logger.info(f'Get table info "{self.schema_name}"."{self.table_name}"')
@@ -82,11 +159,16 @@ class PgRebuildTable:
         self.new_table_full_name = f'"{self.table.schema_name}"."{self.table.table_name}__new"'
         self.delta_table_full_name = f'"{self.table.schema_name}"."{self.table.table_name}__delta"'
         self.apply_delta_func_name = f'"{self.table.schema_name}"."{self.table.table_name}__apply_delta"'
+        if self.archive_file:
+            # rows are archived to a temporary table and exported to the file after each chunk
+            self.archive_table_full_name = 'pg_temp.rebuild_table__archive'
+        else:
+            self.archive_table_full_name = f'"{self.service_schema}"."{self.table.table_name}__archive"'
 
-    async def _db_exec(self, query):
+    async def _db_exec(self, query, conn=None):
         if query:
             self.logger.debug(f'db execute {query=}')
-            await self.db.conn.execute(query)
+            await (conn or self.db.conn).execute(query)
             self.logger.debug('db executed')
 
     async def _cleanup(self, clean=True):
@@ -101,6 +183,30 @@ class PgRebuildTable:
             await self._db_exec(f'drop table if exists {self.delta_table_full_name}')
             self.logger.info('helper objects removed')
 
+    async def _set_phase_settings(self, phase, conn=None, is_local=True):
+        settings = self.phase_settings.get(phase)
+        if not settings:
+            return
+        effective = await (conn or self.db.conn).fetch(
+            '''select s.name, set_config(s.name, s.setting, $3) as setting
+                 from unnest($1::text[], $2::text[]) as s(name, setting)''',
+            list(settings),
+            list(settings.values()),
+            is_local
+        )
+        message = f'{phase} settings: ' + ', '.join(f'{r["name"]}={r["setting"]}' for r in effective)
+        if phase in self.logged_phases:
+            self.logger.debug(message)
+        else:
+            self.logger.info(message)
+            self.logged_phases.add(phase)
+
+    async def _reset_phase_settings(self, phase, conn=None):
+        await self._db_exec(
+            '\n'.join(f'reset {name};' for name in self.phase_settings.get(phase, {})),
+            conn
+        )
+
     async def _create_table_new(self):
         self.logger.info(f'create table new {self.new_table_full_name}')
 
@@ -121,7 +227,9 @@ class PgRebuildTable:
             columns.append(column)
 
         async with self.db.conn.transaction():
-            await self._db_exec(f'''create table {self.new_table_full_name}({', '.join(columns)})''')
+            await self._db_exec(
+                f'''create {'unlogged ' if self.low_wal else ''}table {self.new_table_full_name}({', '.join(columns)})'''
+            )
             await self._db_exec(
                 '\n'.join(
                     f'''comment on column {self.new_table_full_name}.{c.name} is {c.comment};'''
@@ -136,6 +244,14 @@ class PgRebuildTable:
                     if c.statistics
                 )
             )
+            await self._db_exec(
+                '\n'.join(
+                    f'''alter table only {self.new_table_full_name} alter {c.name} set ({', '.join(c.options)});'''
+                    for c in self.table.columns
+                    if c.options
+                )
+            )
+            await self._db_exec('\n'.join(self.table.create_statistics))
             await self._db_exec('\n'.join(self.table.storage_parameters))
             await self._db_exec(f'''alter table {self.new_table_full_name} set (autovacuum_enabled = false);''')
             await self._db_exec('\n'.join(self.table.grant_privileges))
@@ -165,6 +281,9 @@ class PgRebuildTable:
 
     async def _create_objects_delta(self):
         self.logger.info(f'create table delta {self.delta_table_full_name}')
+        delta_columns = ', '.join(self.table.source_columns)
+        new_columns = ', '.join(f'new.{c}' for c in self.table.source_columns)
+        old_columns = ', '.join(f'old.{c}' for c in self.table.source_columns)
         async with self.db.conn.transaction():
             await self._db_exec(
                 f'create unlogged table {self.delta_table_full_name}('
@@ -174,7 +293,13 @@ class PgRebuildTable:
                 f'''alter table {self.delta_table_full_name} set (autovacuum_enabled = false);'''
             )
             await self._db_exec(
-                f'alter table {self.delta_table_full_name} add column delta_id serial;'
+                '\n'.join(
+                    f'alter table {self.delta_table_full_name} drop column {c};'
+                    for c in self.drop_columns or []
+                )
+            )
+            await self._db_exec(
+                f'alter table {self.delta_table_full_name} add column delta_id serial primary key;'
                 f'alter table {self.delta_table_full_name} add column delta_op "char";'
             )
             await self._db_exec(
@@ -182,16 +307,16 @@ class PgRebuildTable:
                 function {self.delta_table_full_name}() returns trigger as $$
                 begin
                   if tg_op = 'INSERT' then
-                    insert into {self.delta_table_full_name}
-                      values (new.*, default, 'i');
+                    insert into {self.delta_table_full_name}({delta_columns}, delta_op)
+                      values ({new_columns}, 'i');
 
                   elsif tg_op = 'UPDATE' then
-                    insert into {self.delta_table_full_name}
-                      values (new.*, default, 'u');
+                    insert into {self.delta_table_full_name}({delta_columns}, delta_op)
+                      values ({new_columns}, 'u');
 
                   elsif tg_op = 'DELETE' then
-                    insert into {self.delta_table_full_name}
-                      values (old.*, default, 'd');
+                    insert into {self.delta_table_full_name}({delta_columns}, delta_op)
+                      values ({old_columns}, 'd');
 
                     return old;
                   end if;
@@ -201,61 +326,92 @@ class PgRebuildTable:
                 $$ language plpgsql security definer;'''
             )
 
-            pk_columns = self.table.pk_columns
-            columns = ', '.join(f'{c.name}' for c in self.table.columns)
-            val_columns = ', '.join(f'r.{c.name}' for c in self.table.columns)
-            where = ' and '.join(f't.{c} = r.{c}' for c in pk_columns)
-            set_columns = ','.join(f'{c.name} = r.{c.name}'
-                                   for c in self.table.columns
-                                   if c.name not in pk_columns)
-
-            await self._db_exec(
-                f'''create or replace
-                    function {self.apply_delta_func_name}() returns integer as $$
-                    declare
-                      r record;
-                      rows integer := 0;
-                    begin
-                      for r in with d as (
-                                 delete from {self.delta_table_full_name}
-                                 returning *
-                               )
-                               select *
-                                 from d
-                                order by delta_id
-                      loop
-                        if r.delta_op = 'i' then
-                          insert into {self.new_table_full_name}({columns})
-                            values ({val_columns})
-                            on conflict do nothing; ''' + (f'''
-
-                        elsif r.delta_op = 'u' then
-                          update {self.new_table_full_name} t
-                             set {set_columns}
-                           where {where}; ''' if set_columns else '') + f'''
-
-                        elsif r.delta_op = 'd' then
-                          delete from {self.new_table_full_name} t
-                           where {where};
-                        end if;
-
-                        rows := rows + 1;
-                      end loop;
-
-                      return rows;
-                    end;
-                    $$ language plpgsql security definer;'''
-            )
+            await self._db_exec(self._get_apply_delta_function_query())
         self.logger.info(f'table delta {self.delta_table_full_name} created')
 
-    def _get_copy_query(self, pk_value=None):
+    def _get_copied_columns(self):
+        # added columns without "using" are not copied, they get their default
+        return [c for c in self.table.columns if c.get('expression') or c.name in self.table.source_columns]
+
+    def _get_apply_delta_function_query(self):
+        pk_columns = self.table.pk_columns
+        copied_columns = self._get_copied_columns()
+        # with column expressions the delta row is transformed into the record x first
+        record = 'x' if any(c.get('expression') for c in copied_columns) else 'r'
+        columns = ', '.join(f'{c.name}' for c in copied_columns)
+        val_columns = ', '.join(f'{record}.{c.name}' for c in copied_columns)
+        where = ' and '.join(f't.{c} = {record}.{c}' for c in pk_columns)
+        set_columns = ','.join(f'{c.name} = {record}.{c.name}'
+                               for c in copied_columns
+                               if c.name not in pk_columns)
+        transform = ''
+        if record == 'x':
+            transform_columns = ', '.join(f'{c.get("expression") or c.name} as {c.name}' for c in copied_columns)
+            source_columns = ', '.join(f'r.{c} as {c}' for c in self.table.source_columns)
+            transform = f'''
+                    select {transform_columns}
+                      into x
+                      from (select {source_columns}) t;
+            '''
+
+        return (
+            f'''create or replace
+                function {self.apply_delta_func_name}(max_rows integer default null) returns integer as $$
+                declare
+                  r record;
+                  x record;
+                  rows integer := 0;
+                begin
+                  for r in with d as (
+                             delete from {self.delta_table_full_name}
+                              where delta_id in (select delta_id
+                                                   from {self.delta_table_full_name}
+                                                  order by delta_id
+                                                  limit max_rows)
+                             returning *
+                           )
+                           select *
+                             from d
+                            order by delta_id
+                  loop {transform}
+                    if r.delta_op = 'i' then
+                      insert into {self.new_table_full_name}({columns})
+                        values ({val_columns})
+                        on conflict do nothing; ''' + (f'''
+
+                    elsif r.delta_op = 'u' then
+                      update {self.new_table_full_name} t
+                         set {set_columns}
+                       where {where}; ''' if set_columns else '') + f'''
+
+                    elsif r.delta_op = 'd' then
+                      delete from {self.new_table_full_name} t
+                       where {where};
+                    end if;
+
+                    rows := rows + 1;
+                  end loop;
+
+                  return rows;
+                end;
+                $$ language plpgsql security definer;'''
+        )
+
+    def _get_copy_query(self, pk_value=None, ctid_range=None):
         self.logger.debug('get incremental query')
         pk_predicate_str = ''
+        ctid_predicate_str = ''
         additional_condition = ''
 
         if self.additional_condition:
             additional_condition += f'where {self.additional_condition}'
 
+        if ctid_range:
+            start_block, stop_block = ctid_range
+            ctid_predicate_str = f"where t.ctid >= '({start_block},0)'::tid"
+            if stop_block is not None:
+                ctid_predicate_str += f" and t.ctid < '({stop_block},0)'::tid"
+
         if pk_value:
             prv_columns = []
             predicate_groups = []
@@ -271,10 +427,23 @@ class PgRebuildTable:
                 prv_columns.append(k)
             pk_predicate_str = f"where ({' or '.join(predicate_groups)})"
         pk_columns = ', '.join(f't.{c}' for c in self.table.pk_columns)
-        ins_columns = ', '.join(f'{c.name}' for c in self.table.columns)
-        columns = ', '.join(f't.{c.name}' for c in self.table.columns)
+        ins_columns = ', '.join(f'{c.name}' for c in self._get_copied_columns())
+        columns = ', '.join(c.get('expression') or f't.{c.name}' for c in self._get_copied_columns())
+        archive = ''
+        archived_count = ''
+        if self.archive:
+            archive = f'''
+                w_a as (
+                  insert into {self.archive_table_full_name}({', '.join(self.table.all_columns)})
+                    select {', '.join(f't.{c}' for c in self.table.all_columns)}
+                      from w_t t
+                     where ({self.additional_condition}) is not true
+                  returning 1
+                ),'''
+            archived_count = '''(select count(1)
+                          from w_a a) as archived_count,'''
 
-        if self.chunk_limit and self.table.pk_columns:
+        if self.chunk_limit and self.table.pk_columns and not ctid_range:
             query = f'''
                 with w_t as (
                   select t.*,
@@ -286,7 +455,7 @@ class PgRebuildTable:
                                    {pk_predicate_str}
                                    order by {pk_columns}
                                    limit {self.chunk_limit}) t) t
-                ),
+                ),{archive}
                 w_i as (
                   insert into {self.new_table_full_name}({ins_columns})
                     select {columns}
@@ -297,11 +466,36 @@ class PgRebuildTable:
                 )
                 select (select count(1)
                           from w_i i) as inserted_count,
+                       {archived_count}
                        t.*
                   from w_t t
                  where t.___max_rn = t.___rn;
             '''
+        elif self.archive:
+            # the table is read once, rows are routed to the new table or to the archive
+            query = f'''
+                with w_t as (
+                  select t.*
+                    from {self.table.table_full_name} t
+                   {ctid_predicate_str}
+                ),{archive}
+                w_i as (
+                  insert into {self.new_table_full_name}({ins_columns})
+                    select {columns}
+                      from w_t t
+                     {additional_condition}
+                  returning 1
+                )
+                select (select count(1)
+                          from w_i i) as inserted_count,
+                       (select count(1)
+                          from w_a a) as archived_count
+            '''
         else:
+            if ctid_predicate_str and self.additional_condition:
+                additional_condition = f'{ctid_predicate_str} and ({self.additional_condition})'
+            elif ctid_predicate_str:
+                additional_condition = ctid_predicate_str
             query = f'''
                 insert into {self.new_table_full_name}({ins_columns})
                   select {columns}
@@ -311,20 +505,408 @@ class PgRebuildTable:
         self.logger.debug(f'get incremental query \n query={query}')
         return query
 
+    async def _create_archive(self, conn=None):
+        if self.archive_file:
+            await self._db_exec(
+                f'create temp table if not exists rebuild_table__archive'
+                f'(like {self.table.table_full_name} excluding all) on commit delete rows',
+                conn
+            )
+        elif self.archive:
+            await self._db_exec(
+                f'create table if not exists {self.archive_table_full_name}'
+                f'(like {self.table.table_full_name} excluding all)',
+                conn
+            )
+
+    async def _copy_chunk(self, conn, query, archive_file):
+        async with conn.transaction():
+            await self._set_phase_settings('copy', conn)
+            if not self.chunk_limit and not self.archive:
+                self.logger.debug(f'db execute {query=}')
+                status = await conn.execute(query)
+                self.stats.copy_rows += int(status.split()[-1])
+                return None
+            chunk = await conn.fetchrow(query)
+            if not chunk:
+                return None
+            self.stats.copy_rows += chunk['inserted_count']
+            if self.archive:
+                self.stats.archive_rows += chunk['archived_count']
+                if archive_file:
+                    await conn.copy_from_table('rebuild_table__archive', output=archive_file, format='csv')
+                self.logger.info(f'chunk copied, rows: {chunk["inserted_count"]}, archived: {chunk["archived_count"]}')
+            return chunk
+
+    async def _copy_range(self, conn, snapshot, start_block, stop_block):
+        start_time = time.monotonic()
+        query = self._get_copy_query(ctid_range=(start_block, stop_block))
+        async with conn.transaction(isolation='repeatable_read'):
+            await self._db_exec(f"set transaction snapshot '{snapshot}'", conn)
+            await self._set_phase_settings('copy', conn)
+            if self.archive:
+                chunk = await conn.fetchrow(query)
+                rows, archived_rows = chunk['inserted_count'], chunk['archived_count']
+            else:
+                self.logger.debug(f'db execute {query=}')
+                rows, archived_rows = int((await conn.execute(query)).split()[-1]), 0
+            await conn.execute(
+                f'''
+                insert into "{self.service_schema}"."copy_progress"(schema_name, table_name, start_block, stop_block, rows, duration)
+                  values ($1, $2, $3, $4, $5, $6)''',
+                self.table.schema_name,
+                self.table.table_name,
+                start_block,
+                stop_block,
+                rows,
+                time.monotonic() - start_time
+            )
+        self.stats.copy_rows += rows
+        self.stats.archive_rows += archived_rows
+        return rows
+
+    async def _copy_ranges(self, ranges, snapshot):
+        async with self.db.session('copy') as conn:
+            while ranges:
+                start_block, stop_block = ranges.pop(0)
+                rows = await self._copy_range(conn, snapshot, start_block, stop_block)
+                self.logger.info(
+                    f'blocks [{start_block}, {stop_block if stop_block is not None else "end"}) copied, '
+                    f'rows: {rows}, ranges left: {len(ranges)}'
+                )
+
+    async def _copy_data_by_ctid(self):
+        self.logger.info('copy table data by block ranges')
+        await self._create_archive()
+        await self.db.conn.execute(
+            f'''
+            delete from "{self.service_schema}"."copy_progress" p
+             where p.schema_name = $1 and
+                   p.table_name = $2''',
+            self.table.schema_name,
+            self.table.table_name
+        )
+        # all workers read the same snapshot, so every row version is copied exactly once
+        async with self.db.conn.transaction(isolation='repeatable_read', readonly=True):
+            snapshot = await self.db.conn.fetchval('select pg_export_snapshot()')
+            blocks = await self.db.conn.fetchval(
+                "select pg_relation_size($1::regclass) / current_setting('block_size')::bigint",
+                self.table.table_full_name
+            )
+            range_blocks = self.copy_range_blocks
+            if self.chunk_limit and self.table.reltuples > 0:
+                range_blocks = max(math.ceil(int(self.chunk_limit) * blocks / self.table.reltuples), 1)
+            ranges = [[b, b + range_blocks] for b in range(0, blocks, range_blocks)] or [[0, None]]
+            # rows in the blocks added after the size was read are copied by the last range
+            ranges[-1][1] = None
+            self.logger.info(f'blocks: {blocks}, ranges: {len(ranges)}, blocks per range: {range_blocks}')
+            await asyncio.gather(*(self._copy_ranges(ranges, snapshot) for _ in range(self.db.jobs)))
+        self.logger.info(f'table data copied, rows: {self.stats.copy_rows}, archived: {self.stats.archive_rows}')
+
     async def _copy_data(self):
+        if self.copy_strategy == 'ctid':
+            await self._copy_data_by_ctid()
+            return
         self.logger.info('copy table data')
+        archive_file = gzip.open(self.archive_file, 'ab') if self.archive_file else None
+        try:
+            async with self.db.session('copy') as conn:
+                await self._create_archive(conn)
+                if self.chunk_limit:
+                    pk_value = None
+                    while True:
+                        pk_value = await self._copy_chunk(conn, self._get_copy_query(pk_value), archive_file)
+                        if not pk_value:
+                            break
+                else:
+                    await self._copy_chunk(conn, self._get_copy_query(), archive_file)
+                if self.archive_file:
+                    await self._db_exec('drop table if exists pg_temp.rebuild_table__archive', conn)
+        finally:
+            if archive_file:
+                archive_file.close()
+        self.logger.info(f'table data copied, rows: {self.stats.copy_rows}, archived: {self.stats.archive_rows}')
+
+    async def _check_low_wal(self):
+        wal_level = await self.db.conn.fetchval("select current_setting('wal_level')")
+        if wal_level != 'minimal':
+            self.logger.error(
+                f'Parameter "low_wal" requires wal_level = minimal (current: {wal_level}). '
+                'Standbys, archiving and logical replication need the full WAL of the copy.'
+            )
+            return False
+        return True
+
+    async def _set_logged(self):
+        relpersistence = await self.db.conn.fetchval(
+            'select c.relpersistence from pg_class c where c.oid = $1::regclass',
+            self.new_table_full_name
+        )
+        if relpersistence != 'u':
+            return
+        self.logger.info(f'set logged table {self.new_table_full_name}')
+        await self._db_exec(f'alter table {self.new_table_full_name} set logged')
+        self.logger.info(f'table {self.new_table_full_name} logged')
+
+    async def _get_wal_lsn(self):
+        async with self.db.session('monitor') as conn:
+            return await conn.fetchval('select pg_current_wal_lsn()::text')
+
+    async def _run_step(self, name, step):
+        wal_lsn = await self._get_wal_lsn()
+        rows = self.stats.copy_rows + self.stats.delta_rows
+        lock_attempts = self.stats.lock_attempts
+        lock_time = self.stats.lock_time
+        start_time = time.monotonic()
+        await step()
+        duration = time.monotonic() - start_time
+        rows = self.stats.copy_rows + self.stats.delta_rows - rows
+        lock_attempts = self.stats.lock_attempts - lock_attempts
+        lock_time = self.stats.lock_time - lock_time
+        async with self.db.session('monitor') as conn:
+            wal_bytes, wal_size = await conn.fetchrow(
+                '''select d.wal_bytes, pg_size_pretty(d.wal_bytes)
+                     from (select pg_wal_lsn_diff(pg_current_wal_lsn(), $1::pg_lsn)::bigint as wal_bytes) d''',
+                wal_lsn
+            )
+            self.stats.steps[name] = Munch(duration=duration, rows=rows, wal_bytes=wal_bytes)
+            self.logger.info(f'{name}: wal generated {wal_size}')
+            await conn.execute(
+                f'''
+                insert into "{self.service_schema}"."run_phase"(run_id, phase_name, duration, rows, bytes, wal_bytes, lock_attempts, lock_time)
+                  values ($1, $2, $3, $4, $5, $6, $7, $8)''',
+                self.run_id,
+                name,
+                duration,
+                rows,
+                self.table.get(self.step_size_source.get(name), 0),
+                wal_bytes,
+                lock_attempts,
+                lock_time
+            )
+
+    async def _start_run(self):
+        self.run_id = await self.db.conn.fetchval(
+            f'''
+            insert into "{self.service_schema}"."run"(schema_name, table_name, options, status, before_total_size)
+              values ($1, $2, $3::text::jsonb, 'running', pg_total_relation_size($4::regclass))
+            returning run_id''',
+            self.table.schema_name,
+            self.table.table_name,
+            json.dumps(self.options, default=str),
+            self.table.table_full_name
+        )
+        self.logger.info(f'run {self.run_id} started')
+
+    async def _finish_run(self, status):
+        await self.db.conn.execute(
+            f'''
+            update "{self.service_schema}"."run" r
+               set status = $2,
+                   stop_time = now(),
+                   duration = extract(epoch from now() - r.start_time),
+                   copy_rows = $3,
+                   archive_rows = $4,
+                   delta_rows = $5,
+                   lock_attempts = $6,
+                   lock_time = $7,
+                   wal_bytes = (select sum(p.wal_bytes)
+                                  from "{self.service_schema}"."run_phase" p
+                                 where p.run_id = r.run_id),
+                   after_total_size = pg_total_relation_size(to_regclass($8))
+             where r.run_id = $1''',
+            self.run_id,
+            status,
+            self.stats.copy_rows,
+            self.stats.archive_rows,
+            self.stats.delta_rows,
+            self.stats.lock_attempts,
+            self.stats.lock_time,
+            self.table.table_full_name
+        )
+        self.run_done = True
+        self.logger.info(f'run {self.run_id} {status}')
+
+    def _get_steps(self):
+        steps = []
+        if not self.only_steps:
+            steps.extend([
+                ('create table new', self._create_table_new),
+                ('create objects delta', self._create_objects_delta),
+                ('create trigger delta', self._create_trigger_delta_on_table),
+                ('copy data', self._copy_data),
+            ])
+            if self.low_wal:
+                steps.append(('set logged', self._set_logged))
+            steps.append(('create pk index', self._create_pk_index))
+            steps.append(('create indexes', self._create_indexes))
+            if self.make_vacuum_analyze:
+                steps.append(('vacuum analyze', self._vacuum_analyze))
+            else:
+                steps.append(('analyze', self._analyze))
+        if 'switch' in self.only_steps or not self.only_steps:
+            steps.append(('switch table', self._switch_table))
+        if 'validate_constraints' in self.only_steps or not self.only_steps:
+            steps.append(('validate constraints', self._validate_constraints))
+        if 'indexes' in self.only_steps:
+            steps.append(('rebuild indexes', self._rebuild_indexes))
+        if 'verify' in self.only_steps or self.verify and ('switch' in self.only_steps or not self.only_steps):
+            steps.append(('verify', self._verify_table))
+        return steps
+
+    async def _get_step_durations(self, steps):
+        durations = {}
+        if not await self.db.conn.fetchval(f'''select to_regclass('"{self.service_schema}"."run_phase"') is not null'''):
+            return durations
+        history = await self.db.conn.fetch(
+            f'''
+            select h.phase_name as step_name,
+                   sum(h.bytes) as bytes,
+                   sum(h.duration) as duration,
+                   avg(h.duration) as avg_duration
+              from (select p.*,
+                           -- the runs of the same table come first
+                           row_number() over(partition by p.phase_name
+                                             order by (r.schema_name = $3 and r.table_name = $4) desc, p.stop_time desc) as rn
+                      from "{self.service_schema}"."run_phase" p
+                     inner join "{self.service_schema}"."run" r
+                             on r.run_id = p.run_id
+                     where p.phase_name = any($1::text[]) and
+                           r.status = 'done') h
+             where h.rn <= $2
+             group by h.phase_name''',
+            [name for name, _ in steps],
+            self.step_history_limit,
+            self.table.schema_name,
+            self.table.table_name
+        )
+        for h in history:
+            size = self.table.get(self.step_size_source.get(h['step_name']), 0)
+            if size and h['bytes'] and h['duration']:
+                durations[h['step_name']] = float(size * h['duration'] / h['bytes'])
+            else:
+                durations[h['step_name']] = float(h['avg_duration'])
+        return durations
+
+    async def _get_estimate(self):
+        estimate = Munch(
+            rows=self.table.reltuples,
+            chunks=None,
+        )
+        if self.additional_condition:
+            plan = await self.db.conn.fetchval(
+                f'''explain (format json) select 1 from {self.table.table_full_name} t where {self.additional_condition}'''
+            )
+            estimate.rows = plan[0]['Plan']['Plan Rows']
         if self.chunk_limit:
-            pk_value = None
-            while True:
-                query = self._get_copy_query(pk_value)
-                async with self.db.conn.transaction():
-                    pk_value = await self.db.conn.fetchrow(query)
-                    if not pk_value:
-                        break
-        else:
-            async with self.db.conn.transaction():
-                await self._db_exec(self._get_copy_query())
-        self.logger.info('table data copied')
+            estimate.chunks = math.ceil(max(self.table.reltuples, 0) / int(self.chunk_limit)) + 1
+        fraction = min(estimate.rows / self.table.reltuples, 1) if self.table.reltuples > 0 else 1
+        estimate.heap_bytes = int(self.table.table_size * fraction)
+        estimate.index_bytes = int(self.table.indexes_size * fraction)
+        estimate.step_durations = await self._get_step_durations(self._get_steps())
+        estimate.duration = sum(estimate.step_durations.values())
+
+        write_rate = await self.db.conn.fetchval(
+            '''
+            select (s.n_tup_ins + s.n_tup_upd + s.n_tup_del) /
+                   greatest(extract(epoch from now() - coalesce(d.stats_reset, pg_postmaster_start_time())), 1)
+              from pg_stat_user_tables s
+             cross join pg_stat_database d
+             where s.relid = $1::regclass and
+                   d.datname = current_database()''',
+            self.table.table_full_name
+        )
+        row_width = self.table.table_size / self.table.reltuples if self.table.reltuples > 0 else 0
+        estimate.delta_bytes = int(float(write_rate or 0) * estimate.duration * row_width)
+        estimate.wal_bytes = estimate.delta_bytes
+        if not self.low_wal:
+            estimate.wal_bytes += estimate.heap_bytes + estimate.index_bytes
+        # WAL is written to pg_wal, which is often on another volume, so it is not part of the tablespace total
+        estimate.total_bytes = estimate.heap_bytes + estimate.index_bytes + estimate.delta_bytes
+
+        estimate.tablespace_name, estimate.tablespace_size = await self.db.conn.fetchrow(
+            '''
+            select ts.spcname, pg_tablespace_size(ts.oid)
+              from pg_class c
+             cross join pg_database d
+             inner join pg_tablespace ts
+                     on ts.oid = coalesce(nullif(c.reltablespace, 0), d.dattablespace)
+             where c.oid = $1::regclass and
+                   d.datname = current_database()''',
+            self.table.table_full_name
+        )
+        estimate.free_bytes = None
+        if self.space_limit:
+            space_limit = await self.db.conn.fetchval('select pg_size_bytes($1)', self.space_limit)
+            estimate.free_bytes = space_limit - estimate.tablespace_size
+        return estimate
+
+    def _check_space(self, estimate):
+        if estimate.free_bytes is not None and estimate.total_bytes > estimate.free_bytes:
+            self.logger.error(
+                f'Not enough space: estimated {self._pretty_size(estimate.total_bytes)}, '
+                f'free {self._pretty_size(estimate.free_bytes)} '
+                f'(tablespace "{estimate.tablespace_name}" size {self._pretty_size(estimate.tablespace_size)}, '
+                f'limit {self.space_limit})'
+            )
+            return False
+        return True
+
+    @staticmethod
+    def _pretty_size(size):
+        for unit in ('bytes', 'kB', 'MB', 'GB'):
+            if abs(size) < 1024:
+                return f'{size:.0f} {unit}'
+            size /= 1024
+        return f'{size:.0f} TB'
+
+    async def _explain_copy_query(self):
+        transaction = self.db.conn.transaction()
+        await transaction.start()
+        try:
+            await self._create_table_new()
+            if self.archive and not self.archive_file:
+                # the service schema may not exist before the first rebuild
+                await self._db_exec(f'create schema if not exists "{self.service_schema}";')
+            await self._create_archive()
+            if self.copy_strategy == 'ctid':
+                return await self.db.conn.fetch(f'explain {self._get_copy_query(ctid_range=(0, self.copy_range_blocks))}')
+            return await self.db.conn.fetch(f'explain {self._get_copy_query()}')
+        finally:
+            await transaction.rollback()
+
+    async def _make_plan(self):
+        estimate = await self._get_estimate()
+        self.logger.info(f'plan for table {self.table.table_full_name}:')
+        for i, (name, _) in enumerate(self._get_steps(), 1):
+            duration = estimate.step_durations.get(name)
+            duration = timedelta(seconds=round(duration)) if duration is not None else 'unknown'
+            self.logger.info(f'  {i}. {name} (estimated duration: {duration})')
+        if not self.only_steps:
+            if await self.db.conn.fetchval('select to_regclass($1) is not null', self.new_table_full_name):
+                self.logger.warning(
+                    f'table {self.new_table_full_name} of a previous run exists, the rebuild can not start '
+                    f'until it is removed with --clean, copy query plan is not shown'
+                )
+            else:
+                self.logger.info('copy query plan:')
+                for r in await self._explain_copy_query():
+                    self.logger.info(f'  {r[0]}')
+        self.logger.info(f'rows: {estimate.rows:.0f} of {self.table.reltuples:.0f}, chunks: {estimate.chunks or 1}')
+        self.logger.info(
+            f'estimated size: heap {self._pretty_size(estimate.heap_bytes)}, '
+            f'indexes {self._pretty_size(estimate.index_bytes)}, '
+            f'delta {self._pretty_size(estimate.delta_bytes)}, '
+            f'total in tablespace {self._pretty_size(estimate.total_bytes)}'
+        )
+        self.logger.info(f'estimated wal (pg_wal): {self._pretty_size(estimate.wal_bytes)}')
+        self.logger.info(f'estimated duration: {timedelta(seconds=round(estimate.duration))}')
+        free_size = self._pretty_size(estimate.free_bytes) if estimate.free_bytes is not None else 'unknown'
+        self.logger.info(
+            f'tablespace "{estimate.tablespace_name}": size {self._pretty_size(estimate.tablespace_size)}, free {free_size}'
+        )
+        if self._check_space(estimate):
+            self.logger.info('plan done')
 
     def _get_next_index(self):
         try:
@@ -333,61 +915,370 @@ class PgRebuildTable:
             return None
 
     async def _cancel_autovacuum(self):
-        res = await self._db_exec(
-            f'''
-            select pg_cancel_backend(pid)
-              from pg_stat_activity
-             where state = 'active' and
-                   backend_type = 'autovacuum worker' and
-                   query ~ '{self.table.table_name}';
-            '''
-        )
+        async with self.db.session('monitor') as conn:
+            res = await conn.fetch(
+                f'''
+                select pg_cancel_backend(pid)
+                  from pg_stat_activity
+                 where state = 'active' and
+                       backend_type = 'autovacuum worker' and
+                       query ~ '{self.table.table_name}';
+                '''
+            )
         if res:
             self.logger.info('autovacuum canceled')
 
     async def _vacuum_analyze(self):
         self.logger.info(f'vacuum analyze table {self.new_table_full_name}')
-        await self._db_exec(f'analyze {self.new_table_full_name}')
+        async with self.db.conn.transaction():
+            await self._set_phase_settings('analyze')
+            await self._db_exec(f'analyze {self.new_table_full_name}')
         self.logger.info(f'vacuum and analysis for table {self.new_table_full_name} done')
 
     async def _analyze(self):
         self.logger.info(f'analyze table {self.new_table_full_name}')
-        await self._db_exec(f'analyze {self.new_table_full_name}')
+        async with self.db.conn.transaction():
+            await self._set_phase_settings('analyze')
+            await self._db_exec(f'analyze {self.new_table_full_name}')
         self.logger.info(f'table {self.new_table_full_name} analyzed')
 
+    async def _create_pk_index(self):
+        self.logger.info(f'create primary key index {self.table.create_pk_index}')
+        async with self.db.conn.transaction():
+            await self._set_phase_settings('create_indexes')
+            await self._db_exec(self.table.create_pk_index)
+        self.logger.info('primary key index created')
+
     async def _create_indexes(self):
         self.logger.info('create indexes')
 
+        if self.background_delta:
+            await self._start_delta_applier()
+
         if not self.table.create_indexes:
             return
 
         try:
             while True:
+                self._check_delta_applier()
                 index_def = self._get_next_index()
                 if not index_def:
                     break
                 self.logger.info(f'create index {index_def}')
-                await self._db_exec(index_def)
+                if self.background_delta:
+                    # the delta applier writes to the table while the index is being built
+                    index_def = re.sub('^CREATE (UNIQUE )?INDEX ', 'CREATE \\1INDEX CONCURRENTLY ', index_def)
+                    await self._set_phase_settings('create_indexes', is_local=False)
+                    # concurrent builds wait for the transactions of the applier instead of failing on lock_timeout
+                    await self._db_exec("select set_config('lock_timeout', '0', false)")
+                    try:
+                        await self._db_exec(index_def)
+                    finally:
+                        await self._db_exec('reset lock_timeout')
+                        await self._reset_phase_settings('create_indexes')
+                else:
+                    async with self.db.conn.transaction():
+                        await self._set_phase_settings('create_indexes')
+                        await self._db_exec(index_def)
                 self.logger.info('index created')
         except Exception as e:
             raise e
         self.logger.info('indexes created')
 
-    async def _apply_delta(self):
-        self.logger.info('apply data delta')
-        rows = await self.db.conn.fetchrow(
-            f'''select {self.apply_delta_func_name}() as rows;'''
+    async def _drop_invalid_indexes(self, index):
+        # leftovers of a failed REINDEX CONCURRENTLY (<name>_ccnew) or CREATE INDEX CONCURRENTLY (<name>__new)
+        for invalid_index in await self.db.conn.fetch(
+            '''
+            select format('%I.%I', n.nspname, c.relname) as index_name
+              from pg_index i
+             inner join pg_class c
+                     on c.oid = i.indexrelid
+             inner join pg_namespace n
+                     on n.oid = c.relnamespace
+             where i.indrelid = $1::regclass and
+                   not i.indisvalid and
+                   (quote_ident(c.relname) = $2 or
+                    c.relname like (select left(ic.relname, 57) from pg_class ic where ic.oid = $3::regclass) || '%\\_ccnew%')''',
+            self.table.table_full_name,
+            index['new_index_name'],
+            index['index_name']
+        ):
+            self.logger.warning(f'drop invalid index {invalid_index["index_name"]}')
+            await self._db_exec(f'drop index concurrently if exists {invalid_index["index_name"]}')
+
+    async def _rebuild_index(self, index, is_reindex_concurrently):
+        conn = self.db.conn
+        self.logger.info(f'rebuild index {index["index_name"]}, size: {self._pretty_size(index["size"])}')
+        await self._set_phase_settings('create_indexes', conn, is_local=False)
+        # concurrent builds wait for the transactions on the table instead of failing on lock_timeout
+        await conn.execute("select set_config('lock_timeout', '0', false)")
+        try:
+            if is_reindex_concurrently:
+                await self._db_exec(f'reindex index concurrently {index["index_name"]}', conn)
+            else:
+                await self._db_exec(index['create_index_concurrently'], conn)
+                while True:
+                    try:
+                        async with conn.transaction():
+                            await conn.execute(
+                                "select set_config('lock_timeout', $1, true)",
+                                self.db.server_settings['lock_timeout']
+                            )
+                            await self._set_phase_settings('switch', conn)
+                            await self._db_exec(
+                                f'alter index {index["index_name"]} rename to {index["old_index_name"]};'
+                                f'alter index {index["schema_name"]}.{index["new_index_name"]} rename to {index["relname"]};',
+                                conn
+                            )
+                        break
+                    except asyncpg.exceptions.LockNotAvailableError:
+                        self.logger.warning(f'Rename index {index["index_name"]} failed. Try in 20 seconds.')
+                        await asyncio.sleep(20)
+                await self._db_exec(f'drop index concurrently {index["schema_name"]}.{index["old_index_name"]}', conn)
+        except Exception as e:
+            self.logger.error(f'rebuild index {index["index_name"]}: {e}')
+            await self._drop_invalid_indexes(index)
+            raise
+        finally:
+            await self._db_exec('reset lock_timeout', conn)
+            await self._reset_phase_settings('create_indexes', conn)
+        size = await conn.fetchval('select pg_relation_size($1::regclass)', index['index_name'])
+        self.logger.info(
+            f'index {index["index_name"]} rebuilt, size: {self._pretty_size(index["size"])} -> {self._pretty_size(size)}'
+        )
+
+    async def _rebuild_indexes(self):
+        self.logger.info('rebuild indexes')
+        is_reindex_concurrently = await self.db.conn.fetchval(
+            "select current_setting('server_version_num')::integer >= 120000"
         )
-        self.logger.info('data delta applied')
+        indexes = []
+        for index in await self.db.conn.fetch(self.INDEX_INFO_QUERY, self.table.table_full_name):
+            bloat = f'{index["bloat_ratio"]:.0%}' if index['bloat_ratio'] is not None else 'unknown'
+            if index['bloat_ratio'] is None and self.index_bloat_threshold > 0 \
+                    or index['bloat_ratio'] is not None and index['bloat_ratio'] * 100 < self.index_bloat_threshold:
+                self.logger.info(f'skip index {index["index_name"]}, estimated bloat: {bloat}')
+            elif index['is_constraint'] and not is_reindex_concurrently:
+                self.logger.warning(f'skip index {index["index_name"]} of constraint, REINDEX CONCURRENTLY requires PostgreSQL 12')
+            else:
+                self.logger.info(f'index {index["index_name"]}, estimated bloat: {bloat}')
+                indexes.append(index)
+        # concurrent index builds on one table conflict on SHARE UPDATE EXCLUSIVE, so they run one by one
+        for index in indexes:
+            await self._rebuild_index(index, is_reindex_concurrently)
+        self.logger.info(f'indexes rebuilt: {len(indexes)}')
+
+    async def _drain_delta(self):
+        async with self.db.session('delta') as conn:
+            while not self.delta_applier_stop.is_set():
+                try:
+                    # short transactions, so the concurrent index builds do not wait for the whole backlog
+                    rows = await self._apply_delta(conn, self.delta_apply_batch_rows)
+                except asyncpg.exceptions.LockNotAvailableError:
+                    self.logger.warning('Apply delta in background failed. Try again.')
+                    rows = 0
+                if rows < self.min_delta_rows:
+                    try:
+                        await asyncio.wait_for(self.delta_applier_stop.wait(), self.delta_apply_interval)
+                    except asyncio.TimeoutError:
+                        pass
+
+    async def _start_delta_applier(self):
+        if self.delta_applier:
+            return
+        self.logger.info('start delta applier')
+        self.delta_applier_stop = asyncio.Event()
+        self.delta_applier = asyncio.ensure_future(self._drain_delta())
+        self.delta_applier.add_done_callback(self._on_delta_applier_done)
+
+    def _on_delta_applier_done(self, task):
+        if not task.cancelled() and task.exception():
+            self.logger.error(f'apply delta in background: {task.exception()}')
+
+    def _check_delta_applier(self):
+        if self.delta_applier and self.delta_applier.done() and not self.delta_applier.cancelled():
+            # raises the error of the background applier
+            self.delta_applier.result()
+
+    async def _stop_delta_applier(self):
+        if not self.delta_applier:
+            return
+        self.logger.info('stop delta applier')
+        self.delta_applier_stop.set()
+        try:
+            await self.delta_applier
+        finally:
+            self.delta_applier = None
+        self.logger.info('delta applier stopped')
+
+    async def _apply_delta(self, conn=None, max_rows=None):
+        self.logger.debug('apply data delta')
+        start_time = time.monotonic()
+        query = f'''select {self.apply_delta_func_name}($1::integer) as rows;'''
+        if conn:
+            async with conn.transaction():
+                await self._set_phase_settings('delta', conn)
+                rows = await conn.fetchrow(query, max_rows)
+        else:
+            rows = await self.db.conn.fetchrow(query, max_rows)
+        self.stats.delta_rows += rows['rows']
+        self.stats.delta_duration += time.monotonic() - start_time
+        self.logger.log(logging.INFO if rows['rows'] else logging.DEBUG, f'data delta applied, rows: {rows["rows"]}')
         return rows['rows']
 
+    async def _get_key_ranges(self, table_name):
+        # ranges of the first primary key column by the histogram of its values
+        bounds = await self.db.conn.fetchval(
+            '''
+            select s.histogram_bounds::text::text[]
+              from pg_stats s
+             where s.schemaname = $1 and
+                   s.tablename = $2 and
+                   quote_ident(s.attname) = $3''',
+            self.table.schema_name,
+            table_name,
+            self.table.pk_columns[0]
+        )
+        if not bounds:
+            return [(None, None)]
+        return list(zip([None] + bounds, bounds + [None]))
+
+    def _get_key_range_conditions(self, lower, upper, args):
+        pk_column = self.table.pk_columns[0]
+        pk_type = next(c.type for c in self.table.columns if c.name == pk_column)
+        conditions = []
+        if lower is not None:
+            args.append(lower)
+            conditions.append(f't.{pk_column} >= ${len(args)}::text::{pk_type}')
+        if upper is not None:
+            args.append(upper)
+            conditions.append(f't.{pk_column} < ${len(args)}::text::{pk_type}')
+        return conditions
+
+    async def _get_prewarm_relations(self):
+        return await self.db.conn.fetch(
+            '''
+            select x.relation::text as relation,
+                   pg_relation_size(x.relation) / current_setting('block_size')::integer as blocks
+              from (select to_regclass(format('%I.%I', icn.nspname, substr(ic.relname, 1, 58) || '__new')) as relation,
+                           0 as priority,
+                           i.indisprimary,
+                           coalesce(s.idx_scan, 0) as idx_scan
+                      from pg_index i
+                     inner join pg_class ic
+                             on ic.oid = i.indexrelid
+                     inner join pg_namespace icn
+                             on icn.oid = ic.relnamespace
+                      left join pg_stat_user_indexes s
+                             on s.indexrelid = i.indexrelid
+                     where i.indrelid = $1::regclass
+                    union all
+                    select to_regclass($2), 1, false, 0) x
+             -- an index added to the table during the rebuild has no __new index
+             where x.relation is not null
+             order by x.priority, x.indisprimary desc, x.idx_scan desc''',
+            self.table.table_full_name,
+            self.new_table_full_name
+        )
+
+    async def _prewarm_relation(self, relation, blocks):
+        async with self.db.session('copy') as conn:
+            self.logger.info(f'prewarm {relation}, blocks: {blocks}')
+            await conn.execute(
+                '''select pg_prewarm($1::regclass, 'buffer', 'main', 0, $2)''',
+                relation,
+                blocks - 1
+            )
+
+    async def _prewarm_pk_ranges(self, ranges, rows):
+        pk_columns = ', '.join(f't.{c}' for c in self.table.pk_columns)
+        async with self.db.session('copy') as conn:
+            while ranges:
+                lower, upper = ranges.pop()
+                args = []
+                conditions = self._get_key_range_conditions(lower, upper, args)
+                async with conn.transaction():
+                    # the heap is read by the index scan, an index only scan would skip it
+                    await conn.execute(
+                        'set local enable_seqscan = off; set local enable_bitmapscan = off; set local enable_indexonlyscan = off;'
+                    )
+                    await conn.execute(
+                        f'''select count(1)
+                              from (select t.*
+                                      from {self.new_table_full_name} t
+                                     where {' and '.join(conditions) or 'true'}
+                                     order by {pk_columns}
+                                     limit {rows}) t''',
+                        *args
+                    )
+
+    async def _prewarm_pk(self, rows):
+        ranges = await self._get_key_ranges(f'{self.table.table_name}__new')
+        self.logger.info(f'prewarm {self.new_table_full_name} by primary key, rows: {rows}, ranges: {len(ranges)}')
+        await asyncio.gather(
+            *(self._prewarm_pk_ranges(ranges, max(rows // len(ranges), 1)) for _ in range(self.db.jobs))
+        )
+
+    async def _prewarm_table(self):
+        budget, block_size = await self.db.conn.fetchrow(
+            '''select coalesce(pg_size_bytes($1), pg_size_bytes(current_setting('shared_buffers')) / 2),
+                      current_setting('block_size')::integer''',
+            self.prewarm_budget
+        )
+        self.logger.info(f'prewarm table {self.new_table_full_name}, budget: {self._pretty_size(budget)}')
+        if await self.db.conn.fetchval("select exists(select 1 from pg_extension where extname = 'pg_prewarm')"):
+            budget_blocks = budget // block_size
+            tasks = []
+            for r in await self._get_prewarm_relations():
+                blocks = min(r['blocks'], budget_blocks)
+                if blocks <= 0:
+                    continue
+                tasks.append(self._prewarm_relation(r['relation'], blocks))
+                budget_blocks -= blocks
+            await asyncio.gather(*tasks)
+        else:
+            # without pg_prewarm the primary key index and the heap are read by an index scan
+            self.logger.warning('Extension pg_prewarm is not installed, only primary key index and heap are prewarmed')
+            row_size = self.table.table_size / self.table.reltuples if self.table.reltuples > 0 else block_size
+            await self._prewarm_pk(max(int(budget / row_size), 1))
+        self.logger.info(f'table {self.new_table_full_name} prewarmed')
+
+    async def _get_delta_inflow(self, conn):
+        return await conn.fetchval(
+            '''select coalesce(pg_sequence_last_value(pg_get_serial_sequence($1, 'delta_id')::regclass), 0)''',
+            self.delta_table_full_name
+        )
+
     async def _switch_table(self):
         self.logger.info('switch table start')
 
-        while True:
-            rows = await self._apply_delta()
-            if rows <= self.min_delta_rows:
-                break
+        await self._stop_delta_applier()
+        await self._set_logged()
+
+        # the delta written while prewarming is drained by the catch-up loop before the lock
+        if self.prewarm:
+            await self._prewarm_table()
+
+        convergence = DeltaConvergence()
+        async with self.db.session('delta') as conn:
+            while True:
+                start_time = time.monotonic()
+                rows = await self._apply_delta(conn)
+                convergence.add(time.monotonic(), await self._get_delta_inflow(conn), rows, time.monotonic() - start_time)
+                predicted_lock_ms = convergence.predict_lock_ms()
+                if predicted_lock_ms is None:
+                    continue
+                self.logger.info(
+                    f'delta inflow {convergence.inflow_rate:.0f} rows/s, drain {convergence.drain_rate or 0:.0f} rows/s, '
+                    f'predicted apply under lock {predicted_lock_ms:.0f} ms (target {self.switch_target_ms} ms)'
+                )
+                if predicted_lock_ms <= self.switch_target_ms:
+                    break
+                if not convergence.is_converging():
+                    self.logger.error(
+                        f'Delta does not converge: {convergence.inflow_rate:.0f} rows/s are written to the table, '
+                        f'only {convergence.drain_rate:.0f} rows/s are applied. Throttle the writers of {self.table.table_full_name}.'
+                    )
 
         if self.table.declarative_partition_expr:
             await self._db_exec(
@@ -398,12 +1289,23 @@ class PgRebuildTable:
 
         while True:
             try:
+                self.stats.lock_attempts += 1
                 async with self.db.conn.transaction():
+                    await self._set_phase_settings('switch')
                     await self._apply_delta()
                     await self._cancel_autovacuum()
                     self.logger.info(f'lock table {self.table.table_full_name}')
                     await self._db_exec(f'lock table {self.table.table_full_name} in access exclusive mode')
+                    lock_start_time = time.monotonic()
                     await self._apply_delta()
+                    await self._db_exec(
+                        f'''
+                        update "{self.service_schema}"."table" t
+                           set switch_txid = txid_current()
+                         where t.schema_name = '{self.table.schema_name}' and
+                               t.table_name = '{self.table.table_name}' '''
+                    )
+                    self.logger.info(f'delta applied under lock in {(time.monotonic() - lock_start_time) * 1000:.0f} ms')
                     await self._db_exec('\n'.join(self.table.drop_functions))
                     await self._db_exec('\n'.join(self.table.drop_views))
                     await self._db_exec('\n'.join(self.table.drop_constraints))
@@ -418,6 +1320,12 @@ class PgRebuildTable:
                     if self.make_backup:
                         self.logger.info(f'backup table {self.table.table_full_name}')
                         await self._db_exec(f'alter table {self.table.table_full_name} set schema {self.service_schema};')
+                        await self._db_exec(
+                            '\n'.join(
+                                f'alter statistics {s} set schema {self.service_schema};'
+                                for s in self.table.statistics_names
+                            )
+                        )
                     else:
                         self.logger.info(f'drop table {self.table.table_full_name}')
                         await self._db_exec(f'drop table {self.table.table_full_name};')
@@ -435,6 +1343,7 @@ class PgRebuildTable:
                             await self._db_exec(f'alter table {self.table.table_full_name} inherit {self.table.inhparent}')
 
                     await self._db_exec('\n'.join(self.table.rename_indexes))
+                    await self._db_exec('\n'.join(self.table.rename_statistics))
                     await self._db_exec('\n'.join(self.table.create_constraints))
                     await self._db_exec('\n'.join(self.table.create_rules))
                     await self._db_exec('\n'.join(self.table.create_triggers))
@@ -472,11 +1381,14 @@ class PgRebuildTable:
                     )
                     await self._db_exec('\n'.join(self.table.add_publication_names))
                     await self._db_exec(f'alter table {self.table.table_full_name} reset (autovacuum_enabled);')
-                    break
+                self.stats.lock_time = time.monotonic() - lock_start_time
+                self.logger.info(f'table {self.table.table_full_name} was locked for {self.stats.lock_time:.3f} seconds')
+                break
             except asyncpg.exceptions.LockNotAvailableError:
                 self.logger.warning('Lock table failed. Try in 20 seconds.')
                 await asyncio.sleep(20)
-                await self._apply_delta()
+                async with self.db.session('delta') as conn:
+                    await self._apply_delta(conn)
             except Exception as e:
                 self.logger.error(f'switch table: {e}')
                 raise
@@ -495,6 +1407,127 @@ class PgRebuildTable:
                 self.logger.warning(re.sub('alter table (.*) validate constraint (.*) failed;', '\\1: \\2', c))
         self.logger.info('constraints validated')
 
+    def _get_verify_query(self, table_full_name, columns, lower, upper, switch_xid, is_backup, only_present=False):
+        args = []
+        conditions = self._get_key_range_conditions(lower, upper, args)
+        pk_join = ' and '.join(f'l.{c} = t.{c}' for c in self.table.pk_columns)
+        if only_present:
+            # the backup rows whose key is not in the table (deleted after the switch) are not compared
+            conditions.append(
+                f'''exists (select
+                              from {self.table.table_full_name} l
+                             where {pk_join})'''
+            )
+        if switch_xid is not None:
+            # rows written to the table after the switch are not compared
+            args.append(switch_xid)
+            if is_backup:
+                conditions.append(
+                    f'''not exists (select
+                                      from {self.table.table_full_name} l
+                                     where {pk_join} and
+                                           age(l.xmin) < age(${len(args)}::text::xid))'''
+                )
+            else:
+                conditions.append(f'age(t.xmin) >= age(${len(args)}::text::xid)')
+        if is_backup and self.additional_condition:
+            conditions.append(f'({self.additional_condition})')
+        # the backup columns of a changed type are cast to the type of the table, as the copy did
+        row_columns = ', '.join(f't.{c}::{c_type}' if is_backup and c_type else f't.{c}' for c, c_type in columns)
+        query = f'''
+            select count(*) as rows,
+                   coalesce(sum(('x' || substr(md5(row({row_columns})::text), 1, 16))::bit(64)::bigint::numeric), 0) as hash
+              from {table_full_name} t
+             where {' and '.join(conditions) or 'true'}'''
+        return query, args
+
+    async def _verify_ranges(self, ranges, backup_table_full_name, columns, switch_xid):
+        async with self.db.session('copy') as conn:
+            while ranges:
+                lower, upper = ranges.pop()
+                query, args = self._get_verify_query(self.table.table_full_name, columns, lower, upper, switch_xid, False)
+                live = await conn.fetchrow(query, *args)
+                query, args = self._get_verify_query(backup_table_full_name, columns, lower, upper, switch_xid, True)
+                backup = await conn.fetchrow(query, *args)
+                self.stats.verify_ranges += 1
+                if live['rows'] == backup['rows'] and live['hash'] == backup['hash']:
+                    self.logger.debug(f'verify range [{lower}, {upper}) of {self.table.pk_columns[0]} matched: rows {live["rows"]}')
+                    continue
+                query, args = self._get_verify_query(backup_table_full_name, columns, lower, upper, switch_xid, True, True)
+                present = await conn.fetchrow(query, *args)
+                if live['rows'] == present['rows'] and live['hash'] == present['hash']:
+                    # deleted after the switch, the delete can not be told apart from a row lost by the rebuild
+                    self.stats.verify_missing_ranges += 1
+                    self.stats.verify_missing_rows += backup['rows'] - present['rows']
+                    self.logger.warning(
+                        f'verify range [{lower}, {upper}) of {self.table.pk_columns[0]}: '
+                        f'{backup["rows"] - present["rows"]} rows of the backup are not in the table (deleted after the switch?), '
+                        f'the other rows matched'
+                    )
+                else:
+                    self.stats.verify_mismatches += 1
+                    self.logger.error(
+                        f'verify range [{lower}, {upper}) of {self.table.pk_columns[0]} mismatched: '
+                        f'rows {backup["rows"]} -> {live["rows"]}, hash {backup["hash"]} -> {live["hash"]}'
+                    )
+
+    async def _verify_table(self):
+        backup_table_full_name = f'"{self.service_schema}"."{self.table.table_name}"'
+        self.logger.info(f'verify table {self.table.table_full_name} against {backup_table_full_name}')
+        if not await self.db.conn.fetchval('select to_regclass($1) is not null', backup_table_full_name):
+            self.logger.error(f'Backup table {backup_table_full_name} does not exist, it is kept by "make_backup"...')
+            return
+        transformed_columns = [c.name for c in self.table.columns if c.get('expression')]
+        columns = [
+            (c['name'], c['type'])
+            for c in await self.db.conn.fetch(
+                '''
+                select quote_ident(a.attname) as name,
+                       case
+                         when (a.atttypid, a.atttypmod) <> (b.atttypid, b.atttypmod)
+                           then format_type(a.atttypid, a.atttypmod)
+                       end as type
+                  from pg_attribute a
+                 inner join pg_attribute b
+                         on b.attrelid = $2::regclass and
+                            b.attname = a.attname and
+                            b.attnum > 0 and
+                            not b.attisdropped
+                 where a.attrelid = $1::regclass and
+                       a.attnum > 0 and
+                       not a.attisdropped
+                 order by a.attnum''',
+                self.table.table_full_name,
+                backup_table_full_name
+            )
+            if c['name'] not in transformed_columns
+        ]
+        switch_xid = await self.db.conn.fetchval(
+            f'''
+            select (t.switch_txid % 4294967296)::text
+              from "{self.service_schema}"."table" t
+             where t.schema_name = $1 and
+                   t.table_name = $2''',
+            self.table.schema_name,
+            self.table.table_name
+        )
+        if switch_xid is None:
+            self.logger.warning('switch transaction is unknown, rows changed after the switch are reported as mismatches')
+        ranges = await self._get_key_ranges(self.table.table_name)
+        self.logger.info(f'verify columns: {", ".join(c for c, _ in columns)}, ranges: {len(ranges)}')
+        await asyncio.gather(
+            *(self._verify_ranges(ranges, backup_table_full_name, columns, switch_xid) for _ in range(self.db.jobs))
+        )
+        if self.stats.verify_missing_ranges:
+            self.logger.warning(
+                f'ranges with rows deleted after the switch or missing: {self.stats.verify_missing_ranges}, '
+                f'rows: {self.stats.verify_missing_rows}'
+            )
+        if self.stats.verify_mismatches:
+            self.logger.error(f'table verified, ranges: {self.stats.verify_ranges}, mismatched: {self.stats.verify_mismatches}')
+        else:
+            self.logger.info(f'table verified, ranges: {self.stats.verify_ranges}, no mismatches')
+
     async def start(self):
         await self._get_table()
 
@@ -514,9 +1547,61 @@ class PgRebuildTable:
             await self._cleanup()
             return
 
+        if self.low_wal and not await self._check_low_wal():
+            return
+
+        self.table.all_columns = [c.name for c in self.table.columns]
+        self.table.source_columns = list(self.table.all_columns)
+
         if self.reorder_columns:
             self.table.columns = self.table.ordered_columns
 
+        if self.drop_columns:
+            for column_name in self.drop_columns:
+                column = next((c for c in self.table.columns if c.name == column_name), None)
+                if not column:
+                    self.logger.error(f'Parameter "drop_columns": column {column_name} does not exist...')
+                    return
+                depends = list(column.depends or [])
+                depends.extend(
+                    'function ' + re.search(r'(?:FUNCTION|PROCEDURE) (\S+?)\(', f).group(1)
+                    for f in self.table.create_functions
+                    if re.search(rf'(?<!\w){re.escape(column_name)}(?!\w)', f)
+                )
+                if depends:
+                    self.logger.error(f'Parameter "drop_columns": column {column_name} is used by {", ".join(depends)}...')
+                    return
+                # the delta does not capture the dropped columns, so the apply function can not evaluate such expressions
+                expressions = [c['using'] for c in (self.set_data_type or []) + (self.add_columns or []) if c.get('using')]
+                if any(re.search(rf'(?<!\w){re.escape(column_name)}(?!\w)', e) for e in expressions):
+                    self.logger.error(f'Parameter "drop_columns": column {column_name} is used by a "using" expression...')
+                    return
+            self.table.columns = [c for c in self.table.columns if c.name not in self.drop_columns]
+            self.table.source_columns = [c for c in self.table.source_columns if c not in self.drop_columns]
+
+        if self.add_columns:
+            for ac in self.add_columns:
+                if any(c.name == ac['name'] for c in self.table.columns):
+                    self.logger.error(f'Parameter "add_columns": column {ac["name"]} already exists...')
+                    return
+                if ac.get('not_null') and not ac.get('using') and ac.get('default') is None:
+                    self.logger.error(f'Parameter "add_columns": column {ac["name"]} is not null without "using" and "default"...')
+                    return
+                self.table.columns.append(
+                    Munch(
+                        name=ac['name'],
+                        type=ac['type'],
+                        collate=None,
+                        not_null=ac.get('not_null', False),
+                        default=ac.get('default'),
+                        comment=None,
+                        acl=None,
+                        statistics=None,
+                        options=None,
+                        expression=ac.get('using'),
+                    )
+                )
+
         if self.set_column_order:
             new_columns = []
             for column_name in self.set_column_order:
@@ -531,6 +1616,36 @@ class PgRebuildTable:
                 for i, c in enumerate(self.table.columns):
                     if c.name == ct['name'] and c.type != ct['type']:
                         self.table.columns[i]['type'] = ct['type']
+                    if c.name == ct['name'] and ct.get('using'):
+                        self.table.columns[i]['expression'] = ct['using']
+
+        if self.copy_strategy == 'ctid':
+            if await self.db.conn.fetchval("select current_setting('server_version_num')::integer < 140000"):
+                self.logger.error('Parameter "copy_strategy" ctid requires PostgreSQL 14 (TID range scan)...')
+                return
+            if self.archive_file:
+                self.logger.error('Parameter "archive_file" is not supported with "copy_strategy" ctid...')
+                return
+
+        if self.verify and not self.make_backup:
+            self.logger.error('Parameter "verify" requires "make_backup"...')
+            return
+
+        if (self.verify or 'verify' in self.only_steps) and \
+                any(c.get('expression') for c in self.table.columns if c.name in self.table.pk_columns):
+            self.logger.error('Parameter "verify" can not be used with a "using" expression on a primary key column...')
+            return
+
+        if self.archive and not self.additional_condition:
+            self.logger.error('Parameters "archive" and "archive_file" require "additional_condition"...')
+            return
+
+        if self.plan:
+            await self._make_plan()
+            return
+
+        if self.space_limit and not self.only_steps and not self._check_space(await self._get_estimate()):
+            return
 
         # FIXME: схема должна создаваться при создании extension
         await self._db_exec(f'create schema if not exists "{self.service_schema}";')
@@ -545,43 +1660,93 @@ class PgRebuildTable:
               before_total_size bigint,
               after_table_size bigint,
               after_total_size bigint,
+              before_indexes_size bigint,
+              after_indexes_size bigint,
+              switch_txid bigint,
               constraint pk_table primary key(schema_name, table_name));'''
         )
-        if not self.only_steps:
+        await self._db_exec(
+            f'''
+            alter table "{self.service_schema}"."table"
+              add column if not exists before_indexes_size bigint,
+              add column if not exists after_indexes_size bigint,
+              add column if not exists switch_txid bigint;'''
+        )
+        await self._db_exec(
+            f'''
+            create table if not exists "{self.service_schema}"."run"(
+              run_id bigserial primary key,
+              schema_name text,
+              table_name text,
+              options jsonb,
+              status text,
+              start_time timestamp default now(),
+              stop_time timestamp,
+              duration numeric,
+              copy_rows bigint,
+              archive_rows bigint,
+              delta_rows bigint,
+              wal_bytes numeric,
+              lock_attempts integer,
+              lock_time numeric,
+              before_total_size bigint,
+              after_total_size bigint);'''
+        )
+        await self._db_exec(
+            f'''
+            create table if not exists "{self.service_schema}"."run_phase"(
+              run_id bigint references "{self.service_schema}"."run"(run_id) on delete cascade,
+              phase_name text,
+              stop_time timestamp default now(),
+              duration numeric,
+              rows bigint,
+              bytes bigint,
+              wal_bytes bigint,
+              lock_attempts integer,
+              lock_time numeric);'''
+        )
+        await self._db_exec(
+            f'''
+            create table if not exists "{self.service_schema}"."copy_progress"(
+              schema_name text,
+              table_name text,
+              start_block bigint,
+              stop_block bigint,
+              rows bigint,
+              duration numeric,
+              stop_time timestamp default now());'''
+        )
+        if not self.only_steps or 'indexes' in self.only_steps:
             await self._db_exec(
                 f'''
-                insert into "{self.service_schema}"."table"(schema_name, table_name, last_start_time, before_table_size, before_total_size)
+                insert into "{self.service_schema}"."table"(schema_name, table_name, last_start_time, before_table_size, before_total_size, before_indexes_size)
                   values ('{self.table.schema_name}',
                           '{self.table.table_name}',
                           now(),
                           pg_table_size('{self.table.table_full_name}'),
-                          pg_total_relation_size('{self.table.table_full_name}'))
+                          pg_total_relation_size('{self.table.table_full_name}'),
+                          pg_indexes_size('{self.table.table_full_name}'))
                 on conflict
                 on constraint pk_table
-                do update set last_start_time = now();'''
+                do update set last_start_time = now(),
+                              before_indexes_size = excluded.before_indexes_size;'''
             )
-            await self._create_table_new()
-            await self._create_objects_delta()
-            await self._create_trigger_delta_on_table()
-            await self._copy_data()
-            await self._create_indexes()
-            if self.make_vacuum_analyze:
-                await self._vacuum_analyze()
-            else:
-                await self._analyze()
 
-        if 'switch' in self.only_steps or not self.only_steps:
-            await self._switch_table()
+        await self._start_run()
+        for name, step in self._get_steps():
+            await self._run_step(name, step)
+        await self._finish_run('done')
+
+        if 'switch' in self.only_steps or 'indexes' in self.only_steps or not self.only_steps:
             await self._db_exec(
                 f'''
                 update "{self.service_schema}"."table" t
                    set after_table_size = pg_table_size('{self.table.table_full_name}'),
-                       after_total_size = pg_total_relation_size('{self.table.table_full_name}')
+                       after_total_size = pg_total_relation_size('{self.table.table_full_name}'),
+                       after_indexes_size = pg_indexes_size('{self.table.table_full_name}')
                  where t.schema_name = '{self.table.schema_name}' and
                        t.table_name = '{self.table.table_name}' '''
             )
-        if 'validate_constraints' in self.only_steps or not self.only_steps:
-            await self._validate_constraints()
 
         await self._db_exec(
             f'''
@@ -592,14 +1757,24 @@ class PgRebuildTable:
         )
 
     async def stop(self):
-        if not self.only_steps:
+        if self.delta_applier:
+            self.delta_applier.cancel()
+            # the error of the applier is already logged by _on_delta_applier_done
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await self.delta_applier
+        if self.run_id and not self.run_done:
+            try:
+                await self._finish_run('failed')
+            except Exception as e:
+                self.logger.warning(f'run {self.run_id} is not finished: {e}')
+        if not self.only_steps and not self.plan:
             await self._cleanup()
 
 
 class Command:
     logger = logging.getLogger('Command')
 
-    def __init__(self):
+    def __init__(self, args=None):
         arg_parser = argparse.ArgumentParser(
             description='Rebuild table ',
             epilog='Report bugs to <viktor-b_90@inbox.ru>.',
@@ -641,7 +1816,7 @@ class Command:
             '-j',
             '--jobs',
             type=int,
-            help='number of connections (default=%(default)s).',
+            help='number of connections for copying data (default=%(default)s).',
             default=2
         )
         arg_parser.add_argument(
@@ -662,6 +1837,12 @@ class Command:
             type=str,
             help='numerical value of the chunk size limit for data transfer. by default the table overlaps completely in one pass.'
         )
+        arg_parser.add_argument(
+            '--copy_strategy',
+            choices=['pk', 'ctid'],
+            help='pk: copy the chunks in the primary key order, ctid: copy the block ranges of the table in parallel (default=%(default)s).',
+            default='pk'
+        )
         arg_parser.add_argument(
             '-st',
             '--statement_timeout',
@@ -702,6 +1883,22 @@ class Command:
             action="store_true",
             help='only validate constraint on "table_full_name"',
         )
+        arg_parser.add_argument(
+            '--only_indexes',
+            action="store_true",
+            help='only rebuild the bloated indexes of "table_full_name" concurrently, the table data is not rewritten',
+        )
+        arg_parser.add_argument(
+            '--index_bloat_threshold',
+            type=int,
+            help='only_indexes: rebuild the indexes with the estimated bloat above this percent (default=%(default)s).',
+            default=30
+        )
+        arg_parser.add_argument(
+            '--only_verify',
+            action="store_true",
+            help='only compare "table_full_name" with its backup in the rebuild_table schema by primary key ranges',
+        )
         arg_parser.add_argument(
             '--reorder_columns',
             action="store_true",
@@ -715,7 +1912,82 @@ class Command:
         arg_parser.add_argument(
             '--set_data_type',
             type=json.loads,
-            help='Сhange column data type.',
+            help='Сhange column data type. "using" sets an expression over the old columns for the new value '
+                 '(example: [{"name":"created", "type":"timestamptz", "using":"to_timestamp(created)"}]).',
+        )
+        arg_parser.add_argument(
+            '--add_columns',
+            type=json.loads,
+            help='Add columns computed from an expression over the old columns. '
+                 '(example: [{"name":"full_name", "type":"text", "using":"first_name || \' \' || last_name"}])',
+        )
+        arg_parser.add_argument(
+            '--drop_columns',
+            type=lambda s: [str(item) for item in s.split(',')],
+            help='Drop columns (example: \'col1,col2\').',
+        )
+        arg_parser.add_argument(
+            '--archive',
+            action="store_true",
+            help='Copy the rows which do not satisfy "additional_condition" to the table rebuild_table.TABLE_NAME__archive.',
+        )
+        arg_parser.add_argument(
+            '--archive_file',
+            type=str,
+            help='Write the rows which do not satisfy "additional_condition" to the gzip compressed CSV file.',
+        )
+        arg_parser.add_argument(
+            '--low_wal',
+            action="store_true",
+            help='Load the new table as unlogged and set it logged after the copy. Requires wal_level = minimal.',
+        )
+        arg_parser.add_argument(
+            '--plan',
+            action="store_true",
+            help='Only print the steps, the copy query plan and the estimated size and duration of the rebuild.',
+        )
+        arg_parser.add_argument(
+            '--space_limit',
+            type=str,
+            help='Maximum size of the tablespace of the table (example: 500GB). The rebuild is not started if the estimated space does not fit.',
+        )
+        arg_parser.add_argument(
+            '--phase_settings',
+            type=json.loads,
+            help='Settings applied with SET LOCAL in the phases copy, delta, create_indexes, analyze and switch. '
+                 '(example: {"create_indexes": {"maintenance_work_mem": "4GB"}, "copy": {"synchronous_commit": null}})',
+        )
+        arg_parser.add_argument(
+            '--phase_settings_file',
+            type=str,
+            help='JSON file with phase settings in the format of --phase_settings.',
+        )
+        arg_parser.add_argument(
+            '--background_delta',
+            action="store_true",
+            help='Apply the delta in background while the secondary indexes are built (concurrently) and the table is analyzed.',
+        )
+        arg_parser.add_argument(
+            '--switch_target_ms',
+            type=int,
+            help='The table is locked for the switch only when the predicted time of applying the delta under the lock '
+                 'is below this number of milliseconds (default=%(default)s).',
+            default=1000
+        )
+        arg_parser.add_argument(
+            '--prewarm',
+            action="store_true",
+            help='Read the new table and its indexes into shared buffers before the switch.',
+        )
+        arg_parser.add_argument(
+            '--prewarm_budget',
+            type=str,
+            help='Maximum size read by --prewarm (example: 8GB, default: half of shared_buffers).',
+        )
+        arg_parser.add_argument(
+            '--verify',
+            action="store_true",
+            help='After the switch compare the table with the backup kept by --make_backup by primary key ranges.',
         )
         arg_parser.add_argument(
             '-d',
@@ -728,7 +2000,12 @@ class Command:
             default='INFO',
             help='Logging level (default=%(default)s).'
         )
-        args = arg_parser.parse_args()
+        args = arg_parser.parse_args(args)
+
+        phase_settings_file = None
+        if args.phase_settings_file:
+            with open(args.phase_settings_file) as f:
+                phase_settings_file = json.load(f)
 
         db = Database(
             host=args.host,
@@ -739,6 +2016,7 @@ class Command:
             lock_timeout=args.lock_timeout,
             statement_timeout=args.statement_timeout,
             work_mem=args.work_mem,
+            jobs=args.jobs,
             logging_level=args.logging_level
         )
 
@@ -751,13 +2029,33 @@ class Command:
             clean=args.clean,
             only_switch=args.only_switch,
             only_validate_constraints=args.only_validate_constraints,
+            only_indexes=args.only_indexes,
+            index_bloat_threshold=args.index_bloat_threshold,
+            only_verify=args.only_verify,
             chunk_limit=args.chunk_limit,
+            copy_strategy=args.copy_strategy,
             reorder_columns=args.reorder_columns,
             set_column_order=args.set_column_order,
             set_data_type=args.set_data_type,
+            add_columns=args.add_columns,
+            drop_columns=args.drop_columns,
+            archive=args.archive,
+            archive_file=args.archive_file,
+            low_wal=args.low_wal,
+            plan=args.plan,
+            space_limit=args.space_limit,
+            phase_settings=get_phase_settings(phase_settings_file, args.phase_settings),
+            background_delta=args.background_delta,
+            switch_target_ms=args.switch_target_ms,
+            prewarm=args.prewarm,
+            prewarm_budget=args.prewarm_budget,
+            verify=args.verify,
+            options={k: v for k, v in vars(args).items() if k != 'password'},
             logging_level=args.logging_level
         )
 
+        self.db = db
+        self.pg_rebuild_table = pg_rebuild_table
         self.components = [db, pg_rebuild_table]
 
     async def start(self):
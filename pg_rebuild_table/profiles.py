@@ -0,0 +1,32 @@
+default_phase_settings = {
+    'copy': {
+        'synchronous_commit': 'off',
+    },
+    'delta': {
+        'synchronous_commit': 'off',
+    },
+    'create_indexes': {
+        'maintenance_work_mem': '1GB',
+        'max_parallel_maintenance_workers': '4',
+    },
+    'analyze': {},
+    # lock_timeout of the switch transaction is --lock_timeout unless it is set here
+    'switch': {},
+}
+
+
+def get_phase_settings(*overrides):
+    phase_settings = {
+        phase: dict(settings)
+        for phase, settings in default_phase_settings.items()
+    }
+    for override in overrides:
+        for phase, settings in (override or {}).items():
+            if phase not in phase_settings:
+                raise ValueError(f'Unknown phase "{phase}" in phase settings')
+            for name, value in settings.items():
+                if value is None:
+                    phase_settings[phase].pop(name, None)
+                else:
+                    phase_settings[phase][name] = str(value)
+    return phase_settings
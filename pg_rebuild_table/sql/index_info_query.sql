@@ -0,0 +1,61 @@
+select x.index_name,
+       x.schema_name,
+       x.relname,
+       x.new_index_name,
+       x.old_index_name,
+       x.amname,
+       x.is_constraint,
+       x.size,
+       case
+         when x.expected_size is not null and x.size > 0
+           then greatest(1 - x.expected_size / x.size, 0)
+       end as bloat_ratio,
+       x.create_index_concurrently
+  from (select format('%I.%I', icn.nspname, ic.relname) as index_name,
+               format('%I', icn.nspname) as schema_name,
+               format('%I', ic.relname) as relname,
+               format('%I', substr(ic.relname, 1, 58) || '__new') as new_index_name,
+               format('%I', substr(ic.relname, 1, 58) || '__old') as old_index_name,
+               am.amname,
+               exists (select 1
+                         from pg_constraint con
+                        where con.conindid = ic.oid) as is_constraint,
+               pg_relation_size(ic.oid) as size,
+               case
+                 when am.amname = 'btree' and
+                      tc.reltuples > 0
+                   -- leaf pages: (tuple header + line pointer + aligned key width) * rows / usable page space * fillfactor
+                   then (ceil(tc.reltuples * (12 + ceil(iw.width / 8.0) * 8) /
+                              ((current_setting('block_size')::numeric - 40) * coalesce(ff.fillfactor, 90) / 100)) + 1) *
+                        current_setting('block_size')::numeric
+               end as expected_size,
+               regexp_replace(pg_get_indexdef(ic.oid),
+                              '^CREATE (UNIQUE )?INDEX \S+ ON',
+                              'CREATE \1INDEX CONCURRENTLY ' || quote_ident(substr(ic.relname, 1, 58) || '__new') || ' ON') as create_index_concurrently
+          from pg_index i
+         inner join pg_class ic
+                 on ic.oid = i.indexrelid
+         inner join pg_namespace icn
+                 on icn.oid = ic.relnamespace
+         inner join pg_class tc
+                 on tc.oid = i.indrelid
+         inner join pg_namespace tcn
+                 on tcn.oid = tc.relnamespace
+         inner join pg_am am
+                 on am.oid = ic.relam
+          left join lateral (select substring(ro.option from 'fillfactor=(\d+)')::integer as fillfactor
+                               from unnest(ic.reloptions) as ro(option)
+                              where ro.option like 'fillfactor=%') ff
+                 on true
+         cross join lateral (select coalesce(sum(s.avg_width), 0) as width
+                               from unnest(i.indkey::int2[]) as k(attnum)
+                              inner join pg_attribute a
+                                      on a.attrelid = i.indrelid and
+                                         a.attnum = k.attnum
+                              inner join pg_stats s
+                                      on s.schemaname = tcn.nspname and
+                                         s.tablename = tc.relname and
+                                         s.attname = a.attname) iw
+         where i.indrelid = $1::regclass and
+               i.indisvalid) x
+ order by x.size desc
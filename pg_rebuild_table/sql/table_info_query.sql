@@ -11,7 +11,11 @@ select n.nspname as schema_name,
        fk.drop_constraints,
        uni.create_constraints || fk.create_constraints as create_constraints,
        i.create_indexes,
+       i.create_pk_index,
        i.rename_indexes,
+       st.create_statistics,
+       st.rename_statistics,
+       st.statistics_names,
        f.create_functions,
        f.drop_functions,
        f.function_acl_to_grants_params,
@@ -40,7 +44,10 @@ select n.nspname as schema_name,
        pg_catalog.pg_get_partition_constraintdef(c.oid) as rebuild_table__partition_constraintdef,
        (select exists (select 1
                          from pg_catalog.pg_inherits chl
-                        where chl.inhparent = c.oid)) as is_child_exists
+                        where chl.inhparent = c.oid)) as is_child_exists,
+       c.reltuples,
+       pg_table_size(c.oid) as table_size,
+       pg_indexes_size(c.oid) as indexes_size
   from pg_class c
  cross join lateral (select c.oid::regclass::text as table_name) tn
  inner join pg_catalog.pg_namespace n
@@ -60,7 +67,16 @@ select n.nspname as schema_name,
                                       'default', pg_get_expr(cd.adbin, cd.adrelid),
                                       'comment', quote_literal(d.description),
                                       'acl', a.attacl,
-                                      'statistics', nullif(a.attstattarget, -1)
+                                      'statistics', nullif(a.attstattarget, -1),
+                                      'options', a.attoptions,
+                                      'depends', (select array_agg(pg_describe_object(dep.classid, dep.objid, dep.objsubid))
+                                                    from pg_depend dep
+                                                   where dep.refclassid = 'pg_class'::regclass and
+                                                         dep.refobjid = c.oid and
+                                                         dep.refobjsubid = a.attnum and
+                                                         dep.classid <> 'pg_attrdef'::regclass and
+                                                         not (dep.classid = 'pg_class'::regclass and
+                                                              dep.objid = c.oid))
                                     ) as column,
                                     a.attname,
                                     a.attnum,
@@ -173,17 +189,10 @@ select n.nspname as schema_name,
                              or
                              fk.confrelid = c.oid) and
                             fk.contype = 'f') fk
- cross join lateral (select coalesce(array_agg(regexp_replace(replace(regexp_replace(replace(pg_get_indexdef(i.indexrelid),
-                                                                                             ic.relname || '" ON ',
-                                                                                             substr(ic.relname, 1, 58) || '__new" ON '),
-                                                                                     ic.relname || ' ON ',
-                                                                                     substr(ic.relname, 1, 58) || '__new ON '),
-                                                                      substr(tic.relname, 1, 58) || '" USING ',
-                                                                      substr(tic.relname, 1, 58) || '__new" USING '),
-                                                             substr(tic.relname, 1, 58) || ' USING ',
-                                                             substr(tic.relname, 1, 58) || '__new USING ')
-                                               order by cardinality(i.indkey) desc),
+ cross join lateral (select coalesce(array_agg(id.def order by cardinality(i.indkey) desc)
+                                               filter (where not i.indisprimary),
                                      '{}') as create_indexes,
+                            min(id.def) filter (where i.indisprimary) as create_pk_index,
                             coalesce(array_agg(format('alter index "%s"."%s" rename to %s;',
                                                       icn.nspname,
                                                       (substr(ic.relname, 1, 58) || '__new')::name,
@@ -196,7 +205,58 @@ select n.nspname as schema_name,
                               on tic.oid = i.indrelid
                       inner join pg_namespace icn
                               on icn.oid = ic.relnamespace
+                      cross join lateral (select regexp_replace(replace(regexp_replace(replace(pg_get_indexdef(i.indexrelid),
+                                                                                           ic.relname || '" ON ',
+                                                                                           substr(ic.relname, 1, 58) || '__new" ON '),
+                                                                                   ic.relname || ' ON ',
+                                                                                   substr(ic.relname, 1, 58) || '__new ON '),
+                                                                    substr(tic.relname, 1, 58) || '" USING ',
+                                                                    substr(tic.relname, 1, 58) || '__new" USING '),
+                                                            substr(tic.relname, 1, 58) || ' USING ',
+                                                            substr(tic.relname, 1, 58) || '__new USING ') as def) id
                       where i.indrelid = c.oid) i
+ cross join lateral (select coalesce(array_agg(format('%s; %s',
+                                                      sd.def,
+                                                      case
+                                                        when (to_jsonb(st) ->> 'stxstattarget')::integer >= 0
+                                                          then format('alter statistics %I.%I set statistics %s;',
+                                                                      stn.nspname,
+                                                                      substr(st.stxname, 1, 58) || '__new',
+                                                                      to_jsonb(st) ->> 'stxstattarget')
+                                                      end)),
+                                     '{}') as create_statistics,
+                            coalesce(array_agg(format('alter statistics %I.%I rename to %I;',
+                                                      stn.nspname,
+                                                      substr(st.stxname, 1, 58) || '__new',
+                                                      st.stxname)),
+                                     '{}') as rename_statistics,
+                            coalesce(array_agg(format('%I.%I', stn.nspname, st.stxname)), '{}') as statistics_names
+                       from pg_statistic_ext st
+                      inner join pg_namespace stn
+                              on stn.oid = st.stxnamespace
+                      -- the name of the statistics object and of the table are qualified only if they are not visible
+                      cross join lateral (select pg_get_statisticsobjdef(st.oid) as def,
+                                                 'CREATE STATISTICS ' || format('%I.%I', stn.nspname, st.stxname) || ' ' as qualified_prefix,
+                                                 'CREATE STATISTICS ' || quote_ident(st.stxname) || ' ' as prefix,
+                                                 ' FROM ' || c.oid::regclass::text as suffix) so
+                      cross join lateral (select format('CREATE STATISTICS %I.%I %s FROM %I.%I',
+                                                        stn.nspname,
+                                                        substr(st.stxname, 1, 58) || '__new',
+                                                        substr(so.def,
+                                                               case
+                                                                 when left(so.def, length(so.qualified_prefix)) = so.qualified_prefix
+                                                                   then length(so.qualified_prefix)
+                                                                 else length(so.prefix)
+                                                               end + 1,
+                                                               length(so.def) - length(so.suffix) -
+                                                               case
+                                                                 when left(so.def, length(so.qualified_prefix)) = so.qualified_prefix
+                                                                   then length(so.qualified_prefix)
+                                                                 else length(so.prefix)
+                                                               end),
+                                                        n.nspname,
+                                                        c.relname || '__new') as def) sd
+                      where st.stxrelid = c.oid) st
  cross join lateral (select coalesce(array_agg(format('create view %s as %s; %s; %s;',
                                                       v.oid::regclass::text,
                                                       replace(replace(replace(pg_get_viewdef(v.oid),
@@ -86,7 +86,7 @@ setup(
         'Topic :: UIS:: Microservices',
     ],
     zip_safe=False,
-    packages=find_packages(exclude=['tests', 'examples', '.reports']),
+    packages=find_packages(exclude=['tests', 'examples', 'benchmarks', '.reports']),
     package_data={'': ['*.lua']},
     package_dir={'pg_rebuild_table': 'pg_rebuild_table'},
     include_package_data=True,
@@ -0,0 +1,39 @@
+import unittest
+
+from pg_rebuild_table.convergence import DeltaConvergence
+
+
+class TestDeltaConvergence(unittest.TestCase):
+
+    def test_not_enough_samples(self):
+        convergence = DeltaConvergence()
+        self.assertIsNone(convergence.predict_lock_ms())
+        convergence.add(0, 0, 1000, 1)
+        self.assertIsNone(convergence.predict_lock_ms())
+        self.assertTrue(convergence.is_converging())
+
+    def test_converging(self):
+        convergence = DeltaConvergence(window=3)
+        # 100 rows/s inflow, 1000 rows/s drain
+        convergence.add(0, 0, 1000, 1.0)
+        convergence.add(10, 1000, 1000, 1.0)
+        convergence.add(20, 2000, 100, 0.1)
+        self.assertEqual(convergence.inflow_rate, 100)
+        self.assertEqual(convergence.drain_rate, 1000)
+        self.assertTrue(convergence.is_converging())
+        # 10 rows before the lock -> 0.01s, 1 row under the lock -> 1ms
+        self.assertAlmostEqual(convergence.predict_lock_ms(), 1.0)
+
+    def test_not_converging(self):
+        convergence = DeltaConvergence(window=2)
+        convergence.add(0, 0, 1000, 10)
+        convergence.add(10, 2000, 1000, 10)
+        self.assertEqual(convergence.inflow_rate, 200)
+        self.assertEqual(convergence.drain_rate, 100)
+        self.assertFalse(convergence.is_converging())
+
+    def test_no_writes(self):
+        convergence = DeltaConvergence()
+        convergence.add(0, 10, 0, 0.01)
+        convergence.add(1, 10, 0, 0.01)
+        self.assertEqual(convergence.predict_lock_ms(), 0.0)
@@ -0,0 +1,24 @@
+import unittest
+
+from pg_rebuild_table.profiles import default_phase_settings, get_phase_settings
+
+
+class TestPhaseSettings(unittest.TestCase):
+
+    def test_defaults(self):
+        self.assertEqual(get_phase_settings(), default_phase_settings)
+
+    def test_overrides(self):
+        phase_settings = get_phase_settings(
+            {'copy': {'synchronous_commit': 'on'}, 'analyze': {'default_statistics_target': 1000}},
+            {'copy': {'work_mem': '64MB'}, 'delta': {'synchronous_commit': None}, 'switch': {'lock_timeout': '2s'}},
+        )
+        self.assertEqual(phase_settings['copy'], {'synchronous_commit': 'on', 'work_mem': '64MB'})
+        self.assertEqual(phase_settings['delta'], {})
+        self.assertEqual(phase_settings['analyze'], {'default_statistics_target': '1000'})
+        self.assertEqual(phase_settings['switch'], {'lock_timeout': '2s'})
+        self.assertEqual(default_phase_settings['switch'], {})
+
+    def test_unknown_phase(self):
+        with self.assertRaises(ValueError):
+            get_phase_settings({'vacuum': {'work_mem': '1GB'}})
@@ -0,0 +1,166 @@
+import unittest
+
+from munch import Munch
+
+from pg_rebuild_table.main import PgRebuildTable
+
+
+def get_rebuild_table(columns, additional_condition=None, archive=False, chunk_limit=None):
+    rebuild_table = PgRebuildTable.__new__(PgRebuildTable)
+    rebuild_table.additional_condition = additional_condition
+    rebuild_table.archive = archive
+    rebuild_table.chunk_limit = chunk_limit
+    rebuild_table.table = Munch(
+        pk_columns=['id'],
+        columns=[Munch(name=name, expression=expression) for name, expression in columns],
+        source_columns=['id', 'a', 'b'],
+        all_columns=['id', 'a', 'b'],
+        table_full_name='"public"."t1"',
+    )
+    rebuild_table.new_table_full_name = '"public"."t1__new"'
+    rebuild_table.delta_table_full_name = '"public"."t1__delta"'
+    rebuild_table.apply_delta_func_name = '"public"."t1__apply_delta"'
+    rebuild_table.archive_table_full_name = '"rebuild_table"."t1__archive"'
+    return rebuild_table
+
+
+def normalize(query):
+    return ' '.join(query.split())
+
+
+class TestApplyDeltaFunctionQuery(unittest.TestCase):
+
+    def test_without_expressions(self):
+        query = normalize(get_rebuild_table([('id', None), ('a', None), ('b', None)])._get_apply_delta_function_query())
+        self.assertNotIn('into x', query)
+        self.assertIn('function "public"."t1__apply_delta"(max_rows integer default null)', query)
+        self.assertIn('order by delta_id limit max_rows', query)
+        self.assertIn('insert into "public"."t1__new"(id, a, b) values (r.id, r.a, r.b) on conflict do nothing;', query)
+        self.assertIn('update "public"."t1__new" t set a = r.a,b = r.b where t.id = r.id;', query)
+        self.assertIn('delete from "public"."t1__new" t where t.id = r.id;', query)
+
+    def test_transform_record(self):
+        # b is dropped, c is added, a is converted
+        rebuild_table = get_rebuild_table([('id', None), ('a', 'a::bigint'), ('c', 'a + 1')])
+        rebuild_table.table.source_columns = ['id', 'a']
+        query = normalize(rebuild_table._get_apply_delta_function_query())
+        self.assertIn('select id as id, a::bigint as a, a + 1 as c into x from (select r.id as id, r.a as a) t;', query)
+        self.assertIn('insert into "public"."t1__new"(id, a, c) values (x.id, x.a, x.c) on conflict do nothing;', query)
+        self.assertIn('update "public"."t1__new" t set a = x.a,c = x.c where t.id = x.id;', query)
+        self.assertIn('delete from "public"."t1__new" t where t.id = x.id;', query)
+
+
+class TestCopyQuery(unittest.TestCase):
+
+    def test_one_pass(self):
+        rebuild_table = get_rebuild_table([('id', None), ('a', 'a::bigint'), ('b', None)], 't.a > 1')
+        self.assertEqual(
+            normalize(rebuild_table._get_copy_query()),
+            'insert into "public"."t1__new"(id, a, b) select t.id, a::bigint, t.b from "public"."t1" t where t.a > 1'
+        )
+
+    def test_added_column_without_using(self):
+        rebuild_table = get_rebuild_table([('id', None), ('a', None), ('b', None), ('n', None), ('c', 'a + 1')])
+        self.assertEqual(
+            normalize(rebuild_table._get_copy_query()),
+            'insert into "public"."t1__new"(id, a, b, c) select t.id, t.a, t.b, a + 1 from "public"."t1" t'
+        )
+        query = normalize(rebuild_table._get_apply_delta_function_query())
+        self.assertIn('select id as id, a as a, b as b, a + 1 as c into x', query)
+        self.assertIn('insert into "public"."t1__new"(id, a, b, c) values (x.id, x.a, x.b, x.c)', query)
+        self.assertIn('set a = x.a,b = x.b,c = x.c where', query)
+
+    def test_chunk(self):
+        rebuild_table = get_rebuild_table([('id', None), ('a', None), ('b', None)], chunk_limit=100)
+        query = normalize(rebuild_table._get_copy_query({'id': 10}))
+        self.assertIn('from "public"."t1" t where ((t.id > \'10\' )) order by t.id limit 100', query)
+        self.assertNotIn('w_a', query)
+
+    def test_archive_chunk(self):
+        rebuild_table = get_rebuild_table([('id', None), ('a', None), ('b', None)], 't.a > 1', True, 100)
+        query = normalize(rebuild_table._get_copy_query())
+        self.assertIn(
+            'w_a as ( insert into "rebuild_table"."t1__archive"(id, a, b) select t.id, t.a, t.b from w_t t '
+            'where (t.a > 1) is not true returning 1 )',
+            query
+        )
+        self.assertIn('(select count(1) from w_a a) as archived_count', query)
+        self.assertIn('limit 100', query)
+
+    def test_archive_one_pass(self):
+        rebuild_table = get_rebuild_table([('id', None), ('a', None), ('b', None)], 't.a > 1', True)
+        query = normalize(rebuild_table._get_copy_query())
+        self.assertIn('with w_t as ( select t.* from "public"."t1" t ),', query)
+        self.assertIn('where (t.a > 1) is not true', query)
+        self.assertIn('from w_t t where t.a > 1 returning 1', query)
+
+    def test_ctid_range(self):
+        rebuild_table = get_rebuild_table([('id', None), ('a', None), ('b', None)], 't.a > 1', chunk_limit=100)
+        self.assertEqual(
+            normalize(rebuild_table._get_copy_query(ctid_range=(0, 100))),
+            'insert into "public"."t1__new"(id, a, b) select t.id, t.a, t.b from "public"."t1" t '
+            'where t.ctid >= \'(0,0)\'::tid and t.ctid < \'(100,0)\'::tid and (t.a > 1)'
+        )
+
+    def test_ctid_last_range(self):
+        rebuild_table = get_rebuild_table([('id', None), ('a', None), ('b', None)])
+        self.assertEqual(
+            normalize(rebuild_table._get_copy_query(ctid_range=(100, None))),
+            'insert into "public"."t1__new"(id, a, b) select t.id, t.a, t.b from "public"."t1" t '
+            'where t.ctid >= \'(100,0)\'::tid'
+        )
+
+    def test_ctid_range_archive(self):
+        rebuild_table = get_rebuild_table([('id', None), ('a', None), ('b', None)], 't.a > 1', True)
+        query = normalize(rebuild_table._get_copy_query(ctid_range=(0, 100)))
+        self.assertIn(
+            'with w_t as ( select t.* from "public"."t1" t where t.ctid >= \'(0,0)\'::tid and t.ctid < \'(100,0)\'::tid ),',
+            query
+        )
+        self.assertIn('where (t.a > 1) is not true', query)
+        self.assertIn('from w_t t where t.a > 1 returning 1', query)
+
+
+class TestVerifyQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.rebuild_table = get_rebuild_table([('id', None), ('a', None), ('b', None)], 't.a > 1')
+        self.rebuild_table.table.columns[0].type = 'bigint'
+        self.columns = [('id', None), ('a', 'bigint'), ('b', None)]
+
+    def test_live(self):
+        query, args = self.rebuild_table._get_verify_query('"public"."t1"', self.columns, '10', '20', '1234', False)
+        query = normalize(query)
+        self.assertEqual(args, ['10', '20', '1234'])
+        self.assertIn('md5(row(t.id, t.a, t.b)::text)', query)
+        self.assertIn(
+            'from "public"."t1" t where t.id >= $1::text::bigint and t.id < $2::text::bigint and '
+            'age(t.xmin) >= age($3::text::xid)',
+            query
+        )
+        self.assertNotIn('t.a > 1', query)
+
+    def test_backup(self):
+        query, args = self.rebuild_table._get_verify_query('"rebuild_table"."t1"', self.columns, None, '20', '1234', True)
+        query = normalize(query)
+        self.assertEqual(args, ['20', '1234'])
+        self.assertIn('md5(row(t.id, t.a::bigint, t.b)::text)', query)
+        self.assertIn(
+            'from "rebuild_table"."t1" t where t.id < $1::text::bigint and '
+            'not exists (select from "public"."t1" l where l.id = t.id and age(l.xmin) < age($2::text::xid)) and '
+            '(t.a > 1)',
+            query
+        )
+
+    def test_backup_only_present(self):
+        query, args = self.rebuild_table._get_verify_query('"rebuild_table"."t1"', self.columns, None, None, None, True, True)
+        self.assertEqual(args, [])
+        self.assertIn(
+            'where exists (select from "public"."t1" l where l.id = t.id) and (t.a > 1)',
+            normalize(query)
+        )
+
+    def test_without_switch_xid(self):
+        query, args = self.rebuild_table._get_verify_query('"public"."t1"', self.columns, None, None, None, False)
+        self.assertEqual(args, [])
+        self.assertTrue(normalize(query).endswith('from "public"."t1" t where true'))